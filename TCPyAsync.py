@@ -0,0 +1,186 @@
+"""
+TCPyAsync.py
+
+This module runs the TCPy client on asyncio so one process can drive many transfers at once. The
+TCPyAsyncClient goes through the same CLOSED -> SYN-SENT -> ESTABLISHED -> FIN-WAIT-1 state machine
+as TCPyClient and shares all of its packet, window, retransmission and congestion handling - only
+waiting on the network changes, from select() on a blocking socket to awaiting datagrams delivered by
+a DatagramProtocol. Any number of clients can share one event loop:
+
+    clients = [TCPyAsyncClient(address, client_port, server_port, filename) for ...]
+    results = await send_all(clients)
+
+Errors that would make TCPyClient exit raise TCPyConnectionError instead, so one failed transfer
+doesn't take the rest of the loop down with it.
+"""
+import asyncio
+import collections
+import socket as s
+
+from tcp_client import TCPyClient
+
+
+class TCPyConnectionError(Exception):
+    pass
+
+
+# stands in for the blocking socket on the send side, writing through the connected datagram transport
+class TCPyTransportSocket:
+
+    def __init__(self, sock):
+        self.raw = sock
+        self.transport = None
+
+    def connect(self, address):
+        # the raw socket is connected before the transport is created
+        pass
+
+    def getsockopt(self, *args):
+        return self.raw.getsockopt(*args)
+
+    def sendall(self, data):
+        self.transport.sendto(data)
+
+    # gathers the buffers straight from the socket while the transport has nothing queued, otherwise joins them
+    # behind what is queued so datagrams keep their order
+    def sendmsg(self, buffers):
+        if hasattr(self.raw, 'sendmsg') and not self.transport.get_write_buffer_size():
+            try:
+                self.raw.sendmsg(buffers)
+                return
+            except (BlockingIOError, InterruptedError):
+                pass
+        self.transport.sendto(b''.join(buffers))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.raw.close()
+
+
+# hands datagrams from the event loop to the client they belong to
+class TCPyDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        self.client.deliver(data)
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. nothing listening yet) surface as timeouts through the normal retransmission path
+        pass
+
+
+class TCPyAsyncClient(TCPyClient):
+
+    def __init__(self, dest_address, source_port, dest_port, filename, congestion='reno', mss=None, telemetry=None,
+                 pacing=None, fec=None):
+        # datagrams waiting to be processed, and the future a handler sleeps on while there are none
+        self.inbox = collections.deque()
+        self.waiter = None
+        super().__init__(dest_address, source_port, dest_port, filename, congestion, mss, telemetry, pacing, fec)
+
+    # creates the bound socket now, the transport on top of it is created once the loop is running
+    def open_socket(self):
+        sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
+        sock.bind(('', self.SOURCE_PORT))
+        sock.setblocking(False)
+        # kept apart from self.sock, which telemetry may wrap
+        self.endpoint = TCPyTransportSocket(sock)
+        return self.endpoint
+
+    def abort(self, message):
+        print("ERROR({}): {}".format(self.CURR_STATE, message))
+        print("Shutting down client.")
+        self.sock.close()
+        raise TCPyConnectionError("{}:{} ({}): {}".format(self.DEST_ADDRESS, self.DEST_PORT, self.CURR_STATE, message))
+
+    #                               CONNECTION STATE HANDLERS
+    ############################################################################################
+    async def handle_closed(self):
+        self.endpoint.raw.connect(self.SERVER)
+        loop = asyncio.get_running_loop()
+        self.endpoint.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: TCPyDatagramProtocol(self), sock=self.endpoint.raw)
+        TCPyClient.handle_closed(self)
+
+    async def handle_syn_sent(self):
+        try:
+            for packet in await self.receive_packets(self.syn_time_left()):
+                if self.CURR_STATE == 'SYN-SENT':
+                    self.process_synack(packet)
+        except s.timeout:
+            self.retransmit_syn()
+
+    async def handle_established(self):
+        while True:
+            self.retransmit_expired()
+            self.send_new_data()
+            if self.finish_sending():
+                return
+            try:
+                rec_packets = await self.receive_packets(self.ack_wait_time())
+            except s.timeout:
+                continue
+            self.process_acks(rec_packets)
+
+    async def handle_fin_wait_1(self):
+        while self.scoreboard:
+            self.retransmit_expired()
+            try:
+                rec_packets = await self.receive_packets(self.timer_wait_time())
+            except s.timeout:
+                continue
+            self.process_acks(rec_packets)
+        self.CURR_STATE = 'DONE'
+
+    #                               RECEIVING
+    ############################################################################################
+    # called by the protocol for every datagram, wakes the handler if it is waiting
+    def deliver(self, data):
+        if self.telemetry is not None:
+            self.telemetry.packet(False, data)
+        self.inbox.append(data)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    # waits up to timeout seconds (forever if None) for packets and unpacks everything delivered since the last
+    # call as one batch, raises socket.timeout if none came
+    async def receive_packets(self, timeout):
+        if not self.inbox:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                raise s.timeout()
+            finally:
+                self.waiter = None
+        inbox = self.inbox
+        return [self.unpack_packet(self.SOURCE_ADDRESS, self.DEST_ADDRESS, inbox.popleft()) for _ in range(len(inbox))]
+
+    # runs the state machine until the whole file is sent and ACK'ed
+    async def send_file(self):
+        print("SENDING: File = {} To: {}:{}".format(self.FILENAME, self.DEST_ADDRESS, self.DEST_PORT))
+        try:
+            while self.CURR_STATE != 'DONE':
+                state = self.CURR_STATE
+                await self.TCP_STATES[state]()
+                if self.telemetry is not None and self.CURR_STATE != state:
+                    self.telemetry.event('state', state=self.CURR_STATE)
+            print("Done sending, closing connection.")
+        finally:
+            self.source.close()
+            self.sock.close()
+            if self.telemetry is not None:
+                self.telemetry.close()
+
+    # blocking entry point matching TCPyClient.send()
+    def send(self):
+        asyncio.run(self.send_file())
+
+
+# sends every client's file concurrently on the running loop, failed transfers come back as their exception
+async def send_all(clients):
+    return await asyncio.gather(*(client.send_file() for client in clients), return_exceptions=True)
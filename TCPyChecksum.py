@@ -0,0 +1,125 @@
+"""
+TCPyChecksum.py
+
+This module precomputes checksum sums over the data the TCPy client sends, so building a packet only
+sums its header and options rather than every payload byte in Python. The TCPy checksum is a 16-bit sum
+of big-endian words (see TCPyPacket.sum16), which splits into independent parts the same way the RFC 1071
+one's complement sum does - a packet's checksum is the header's sum plus the payload's sum, and
+changing a few header bytes only needs those words swapped out of the total (RFC 1624).
+
+A payload's words pair up its own bytes, so whether a byte is the high or low half of a word depends on
+where the packet starts. TCPyChecksumIndex keeps running sums of the bytes at even and at odd file
+offsets, sampled every BLOCK bytes, and answers the sum of any (offset, length) as a difference of two
+samples plus the few bytes either side of a block boundary - segments can start anywhere, e.g. short ones
+at the edge of the window, so the index doesn't assume fixed segment boundaries.
+
+The running sums are built with NumPy one REGION at a time as sending reaches it, and each region's
+samples are dropped again once the data under them has been ACK'ed, so the index holds a few regions of
+samples however large the file is. NumPy is only imported once the first index is made, so it stays out of
+the client's start-up, and without it there is no index and packets are summed in full as before.
+"""
+import array
+import collections
+
+numpy = None
+
+# bytes per running sum sample - the most a query sums directly is one BLOCK either side
+BLOCK = 64
+# bytes indexed per NumPy pass
+REGION = 4 * 1024 * 1024
+
+
+# running even/odd byte sums over a read-only buffer such as an mmap of the file being sent, from start on
+# (e.g. where a worker's range of a striped file begins) - payloads before that aren't indexed
+class TCPyChecksumIndex:
+
+    def __init__(self, buffer, start=0):
+        self.buffer = memoryview(buffer)
+        self.size = len(self.buffer)
+        self.data = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        # BLOCK is even, so rounding down keeps every byte's even/odd parity. base moves up a REGION at a time
+        # as regions are released
+        self.base = start - start % BLOCK
+        # sums mod 2**16 of the even and odd offset bytes from base up to base itself, i.e. the first sample
+        self.base_sums = (0, 0)
+        # (even, odd) samples per REGION from base on - the sums up to the end of each of the region's blocks
+        self.regions = collections.deque()
+        self.indexed = self.base
+
+    # extends the running sums by whole regions until offset is covered
+    def extend(self, offset):
+        while self.indexed <= offset and self.indexed < self.size:
+            start = self.indexed
+            end = min(start + REGION, self.size)
+            blocks = (end - start) // BLOCK
+            region = self.data[start : start + blocks * BLOCK].reshape(blocks, BLOCK)
+            if blocks == 0:
+                # the last partial block is summed directly by prefix()
+                self.indexed = self.size
+                break
+            last_even, last_odd = self.sample(self.block_count())
+            even = numpy.cumsum(region[:, 0::2].sum(axis=1, dtype=numpy.uint64))
+            odd = numpy.cumsum(region[:, 1::2].sum(axis=1, dtype=numpy.uint64))
+            self.regions.append((array.array('H', ((even + last_even) & 0xFFFF).astype(numpy.uint16).tobytes()),
+                                 array.array('H', ((odd + last_odd) & 0xFFFF).astype(numpy.uint16).tobytes())))
+            self.indexed = start + blocks * BLOCK
+
+    # number of whole blocks from base summed so far - only the last region can be short of REGION
+    def block_count(self):
+        if not self.regions:
+            return 0
+        return (len(self.regions) - 1) * (REGION // BLOCK) + len(self.regions[-1][0])
+
+    # (even, odd) sums from base up to base + block * BLOCK
+    def sample(self, block):
+        if block == 0:
+            return self.base_sums
+        even, odd = self.regions[(block - 1) // (REGION // BLOCK)]
+        return even[(block - 1) % (REGION // BLOCK)], odd[(block - 1) % (REGION // BLOCK)]
+
+    # (even, odd) byte sums mod 2**16 of everything from base to offset
+    def prefix(self, offset):
+        block = min((offset - self.base) // BLOCK, self.block_count())
+        start = self.base + block * BLOCK
+        tail = self.buffer[start:offset]
+        even, odd = self.sample(block)
+        return (even + sum(tail[0::2])) & 0xFFFF, (odd + sum(tail[1::2])) & 0xFFFF
+
+    # drops the samples of whole regions below offset, nothing before it is summed again. The last region is
+    # kept, the next one's sums carry on from it
+    def release(self, offset):
+        while len(self.regions) > 1 and self.base + REGION <= offset:
+            even, odd = self.regions.popleft()
+            self.base_sums = (even[-1], odd[-1])
+            self.base += REGION
+
+    # the sum16 of the length bytes at offset, as they sum when they start a packet's payload - None before base
+    def payload_sum(self, offset, length):
+        if offset < self.base:
+            return None
+        end = offset + (length & ~1)
+        if end > self.indexed:
+            self.extend(end)
+        start_even, start_odd = self.prefix(offset)
+        end_even, end_odd = self.prefix(end)
+        even = end_even - start_even
+        odd = end_odd - start_odd
+        # the payload's first byte is the high half of a word
+        if offset & 1:
+            return ((odd << 8) + even) & 0xFFFF
+        return ((even << 8) + odd) & 0xFFFF
+
+    def close(self):
+        self.data = None
+        self.buffer.release()
+
+
+# returns an index over buffer from start on, or None if NumPy isn't available
+def checksum_index(buffer, start=0):
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+    return TCPyChecksumIndex(buffer, start)
@@ -0,0 +1,137 @@
+"""
+TCPyCongestion.py
+
+This module holds the congestion controllers the TCPy client consults alongside the receiver's
+advertised window. A controller owns the congestion window (cwnd) and slow start threshold (ssthresh),
+both in bytes, and is told about three kinds of events by the client:
+
+    on_ack(bytes_acked, snd_una, current_time, srtt) - new data was ACK'ed
+    on_loss(bytes_in_flight, snd_nxt, current_time)  - loss detected by duplicate ACKs (fast retransmit)
+    on_timeout(bytes_in_flight, current_time)        - a retransmission timer expired
+
+Fast recovery lasts until SND.UNA passes what was SND.NXT when the loss was detected (RFC 6582), so a
+window with several losses only reduces cwnd once.
+
+The client never has more than min(cwnd, RCV.WND) bytes in flight.
+
+    TCPyReno  - slow start and AIMD congestion avoidance as specified by RFC 5681
+    TCPyCubic - CUBIC congestion avoidance as specified by RFC 9438
+"""
+
+
+# common slow start / loss handling, subclasses choose how the window grows in congestion avoidance
+class TCPyCongestionControl:
+    name = None
+
+    def __init__(self, mss):
+        self.mss = mss
+        # RFC 6928 initial window
+        self.cwnd = min(10 * mss, max(2 * mss, 14600))
+        self.ssthresh = float('inf')
+        self.in_recovery = False
+        self.recover = 0
+
+    def __repr__(self):
+        return "{}(cwnd={}, ssthresh={})".format(type(self).__name__, int(self.cwnd), self.ssthresh)
+
+    # new data ACK'ed - grows the window and ends fast recovery once SND.UNA passes the recovery point
+    def on_ack(self, bytes_acked, snd_una, current_time, srtt=None):
+        if self.in_recovery:
+            if snd_una < self.recover:
+                return
+            self.in_recovery = False
+        if self.cwnd < self.ssthresh:
+            # slow start, growth capped at one segment per ACK (RFC 3465 with L = 1)
+            self.cwnd += min(bytes_acked, self.mss)
+        else:
+            self.congestion_avoidance(bytes_acked, current_time, srtt)
+
+    def congestion_avoidance(self, bytes_acked, current_time, srtt):
+        raise NotImplementedError
+
+    # fast retransmit - reduces the window once per recovery episode
+    def on_loss(self, bytes_in_flight, snd_nxt, current_time):
+        if self.in_recovery:
+            return
+        self.in_recovery = True
+        self.recover = snd_nxt
+        self.reduce(bytes_in_flight, current_time)
+        self.cwnd = self.ssthresh
+
+    # retransmission timeout - falls back to slow start from a single segment
+    def on_timeout(self, bytes_in_flight, current_time):
+        if not self.in_recovery:
+            self.reduce(bytes_in_flight, current_time)
+        self.in_recovery = False
+        self.cwnd = self.mss
+
+    # sets ssthresh after a congestion event
+    def reduce(self, bytes_in_flight, current_time):
+        self.ssthresh = max(bytes_in_flight / 2, 2 * self.mss)
+
+
+class TCPyReno(TCPyCongestionControl):
+    name = 'reno'
+
+    # additive increase - roughly one segment per window of ACK'ed data
+    def congestion_avoidance(self, bytes_acked, current_time, srtt):
+        self.cwnd += self.mss * bytes_acked / self.cwnd
+
+
+class TCPyCubic(TCPyCongestionControl):
+    name = 'cubic'
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss):
+        super().__init__(mss)
+        self.w_max = 0          # window before the last reduction, in segments
+        self.k = 0              # time for the cubic curve to climb back to w_max
+        self.epoch_start = None
+        self.w_est = 0          # Reno-friendly window estimate, in segments
+
+    def congestion_avoidance(self, bytes_acked, current_time, srtt):
+        cwnd = self.cwnd / self.mss
+        if self.epoch_start is None:
+            self.epoch_start = current_time
+            if cwnd < self.w_max:
+                self.k = ((self.w_max - cwnd) / self.C) ** (1 / 3)
+            else:
+                self.k = 0
+                self.w_max = cwnd
+            self.w_est = cwnd
+        t = current_time - self.epoch_start + (srtt or 0)
+        target = self.C * (t - self.k) ** 3 + self.w_max
+        target = min(max(target, cwnd), 1.5 * cwnd)
+        acked = bytes_acked / self.mss
+        # stay at least as aggressive as Reno would be with the same beta
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / cwnd
+        if self.w_est > target:
+            target = self.w_est
+        cwnd += (target - cwnd) / cwnd * acked
+        self.cwnd = cwnd * self.mss
+
+    def reduce(self, bytes_in_flight, current_time):
+        cwnd = self.cwnd / self.mss
+        # fast convergence - release bandwidth sooner when the window keeps shrinking
+        if cwnd < self.w_max:
+            self.w_max = cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = cwnd
+        self.epoch_start = None
+        self.ssthresh = max(self.cwnd * self.BETA, 2 * self.mss)
+
+
+CONGESTION_CONTROLS = {
+    TCPyReno.name: TCPyReno,
+    TCPyCubic.name: TCPyCubic,
+}
+
+
+# returns a new controller for the given algorithm name
+def create_congestion_control(name, mss):
+    try:
+        return CONGESTION_CONTROLS[name](mss)
+    except KeyError:
+        raise ValueError("unknown congestion control '{}' (choose from {})".format(
+            name, ", ".join(CONGESTION_CONTROLS)))
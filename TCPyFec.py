@@ -0,0 +1,233 @@
+"""
+TCPyFec.py
+
+This module adds forward error correction to TCPy. After every block of data segments the client sends a
+parity segment - the XOR of the block's payloads, each zero-padded to the longest - so a receiver missing
+one segment of a block rebuilds it from the others rather than waiting a round trip (or a retransmission
+timeout) for it to be resent. Parity segments carry the block's start as their sequence number and a
+parity option (see TCPyPacket.parity_option) giving the block's length and how many segments are in it.
+
+FEC is offered in the SYN with the largest block the client will use and only turned on if the server
+answers it. The client still reacts to loss - the congestion window is cut as usual - but a lost segment
+whose block has parity on the way is only fast retransmitted if data sent after that parity is ACK'ed
+while the segment is still missing, or REBUILD_WAIT round trips pass after the parity without it being
+ACK'ed - i.e. the receiver couldn't rebuild it (two losses in the block, or the parity segment lost too). A
+loss in the block still being filled sends that block's parity straight away.
+
+The block size trades overhead (1 / block size) against how much loss a block can absorb. It is fixed, or
+adapts to the measured loss rate so the overhead stays around OVERHEAD_PER_LOSS times the loss rate.
+
+    TCPyFecEncoder - client side, XORs sent segments into the open block and tracks the blocks in flight
+    TCPyFecDecoder - receiver side, keeps recent segments and rebuilds a block's one missing segment
+"""
+import bisect
+import heapq
+
+DEFAULT_BLOCK = 16
+MIN_BLOCK = 4
+MAX_BLOCK = 64
+# adaptive block sizes aim for parity overhead of this many times the loss rate
+OVERHEAD_PER_LOSS = 2
+# weight of each ACK batch in the loss rate estimate
+LOSS_GAIN = 1 / 16
+# round trips a lost segment waits on its block's parity before it is retransmitted anyway
+REBUILD_WAIT = 1.25
+
+
+# XORs payload into parity (an int holding length bytes), each zero-padded at the end to the longer of the two
+def xor_into(parity, length, payload):
+    if len(payload) > length:
+        parity <<= 8 * (len(payload) - length)
+        length = len(payload)
+    return parity ^ (int.from_bytes(payload, 'big') << 8 * (length - len(payload))), length
+
+
+# a block whose parity has been sent - sent_nxt is SND.NXT at the time, data past it was sent after the parity
+class TCPyFecBlock:
+    __slots__ = ('start', 'end', 'count', 'sent_nxt', 'sent_time')
+
+    def __init__(self, start, end, count, sent_nxt, sent_time):
+        self.start = start
+        self.end = end
+        self.count = count
+        self.sent_nxt = sent_nxt
+        self.sent_time = sent_time
+
+
+class TCPyFecEncoder:
+
+    def __init__(self, block_size=None):
+        self.adaptive = block_size is None
+        self.block_size = DEFAULT_BLOCK if block_size is None else block_size
+        self.max_block = MAX_BLOCK if block_size is None else block_size
+        self.loss_rate = 0.0
+        # the open block
+        self.start = None
+        self.end = None
+        self.count = 0
+        self.parity = 0
+        self.length = 0
+        # closed blocks not yet ACK'ed, in sequence order, and lost segments waiting on their block's parity
+        self.starts = []
+        self.blocks = []
+        self.deferred = []
+        self.parity_sent = 0
+        self.recovered = 0
+
+    def __repr__(self):
+        return "TCPyFecEncoder(block_size={}{})".format(self.block_size, ", adaptive" if self.adaptive else "")
+
+    # XORs a newly sent segment into the open block, returns True once the block is full
+    def add(self, start, payload):
+        if not self.count:
+            self.start = start
+            self.parity = 0
+            self.length = 0
+        self.parity, self.length = xor_into(self.parity, self.length, payload)
+        self.end = start + len(payload)
+        self.count += 1
+        return self.count >= self.block_size
+
+    # closes the open block, returning its (start, length, count, parity payload) for the parity segment
+    def close_block(self, snd_nxt, current_time):
+        block = TCPyFecBlock(self.start, self.end, self.count, snd_nxt, current_time)
+        self.starts.append(block.start)
+        self.blocks.append(block)
+        self.count = 0
+        self.parity_sent += 1
+        return block.start, block.end - block.start, block.count, self.parity.to_bytes(self.length, 'big')
+
+    # the closed block holding a segment, None if it is still in the open block (or was never in one)
+    def find(self, segment):
+        i = bisect.bisect_right(self.starts, segment.start) - 1
+        if i >= 0 and segment.end <= self.blocks[i].end:
+            return self.blocks[i]
+        return None
+
+    # True if a lost segment may still be rebuilt by the receiver - it was only sent once and its block's
+    # parity is sent or still to come
+    def protects(self, segment):
+        if segment.retransmits:
+            return False
+        return (self.count and segment.start >= self.start) or self.find(segment) is not None
+
+    # lost segments the receiver evidently couldn't rebuild - still missing although data sent after their
+    # block's parity has been ACK'ed, or wait seconds have passed since the parity was sent. Deferred segments
+    # that were ACK'ed meanwhile were rebuilt
+    def overdue(self, snd_una, high_acked, current_time, wait):
+        overdue = []
+        waiting = []
+        for segment in self.deferred:
+            if segment.sacked or segment.end <= snd_una:
+                if not segment.retransmits:
+                    self.recovered += 1
+                continue
+            if segment.retransmits:
+                # the retransmission timer got there first
+                continue
+            block = self.find(segment)
+            if block is not None and (high_acked > block.sent_nxt or current_time - block.sent_time >= wait):
+                overdue.append(segment)
+            else:
+                waiting.append(segment)
+        self.deferred = waiting
+        return overdue
+
+    # seconds until the next deferred segment is overdue by the clock, None if none are waiting on sent parity
+    def time_left(self, current_time, wait):
+        times = [block.sent_time for block in map(self.find, self.deferred) if block is not None]
+        if not times:
+            return None
+        return max(min(times) + wait - current_time, 0)
+
+    # updates the loss rate with one ACK batch and, if adaptive, the size of the blocks to come. Blocks
+    # entirely below snd_una are forgotten
+    def observe(self, lost, acked, snd_una):
+        if lost or acked:
+            self.loss_rate += LOSS_GAIN * (lost / (lost + acked) - self.loss_rate)
+        if self.adaptive:
+            if self.loss_rate > 0:
+                size = round(1 / (OVERHEAD_PER_LOSS * self.loss_rate))
+            else:
+                size = self.max_block
+            self.block_size = min(max(size, MIN_BLOCK), self.max_block)
+        i = 0
+        while i < len(self.blocks) and self.blocks[i].end <= snd_una:
+            i += 1
+        if i:
+            del self.starts[:i]
+            del self.blocks[:i]
+
+
+class TCPyFecDecoder:
+
+    def __init__(self, max_block):
+        self.max_block = max_block
+        self.segments = {}      # offset -> payload of every recently received segment
+        self.ends = {}          # end offset -> offset of the same segments
+        self.offsets = []       # heap of their offsets, for pruning
+        self.longest = 0
+        self.pending = {}       # block start -> (block end, count, parity) not yet rebuilt or complete
+        self.parity = 0
+        self.recovered = 0
+
+    # records a newly received segment
+    def add(self, offset, payload):
+        self.segments[offset] = payload
+        self.ends[offset + len(payload)] = offset
+        heapq.heappush(self.offsets, offset)
+        self.longest = max(self.longest, len(payload))
+
+    # records a parity segment, returning the (offset, payload) of the segment it rebuilds, if any
+    def add_parity(self, offset, block_len, count, parity):
+        self.parity += 1
+        self.pending[offset] = (offset + block_len, count, parity)
+        return self.rebuild(offset)
+
+    # rebuilds whatever the pending parity of the block holding offset now can
+    def check(self, offset):
+        rebuilt = []
+        for start, (end, count, parity) in list(self.pending.items()):
+            if start <= offset < end:
+                segment = self.rebuild(start)
+                if segment is not None:
+                    rebuilt.append(segment)
+        return rebuilt
+
+    # rebuilds the one segment missing from the block at start - None if nothing is missing (the parity is
+    # dropped), or more than one segment is (it is kept in case a retransmission leaves just one)
+    def rebuild(self, start):
+        end, count, parity = self.pending[start]
+        received = []
+        gap_start = start
+        while gap_start < end and gap_start in self.segments:
+            received.append(self.segments[gap_start])
+            gap_start += len(received[-1])
+        if gap_start >= end:
+            del self.pending[start]
+            return None
+        gap_end = end
+        while gap_end > gap_start and gap_end in self.ends:
+            gap_end = self.ends[gap_end]
+            received.append(self.segments[gap_end])
+        if len(received) != count - 1 or gap_end - gap_start > len(parity):
+            return None
+        value, length = int.from_bytes(parity, 'big'), len(parity)
+        for payload in received:
+            value, length = xor_into(value, length, payload)
+        del self.pending[start]
+        self.recovered += 1
+        return gap_start, value.to_bytes(length, 'big')[:gap_end - gap_start]
+
+    # forgets segments too far below rcv_nxt to be in any block still missing data, and parity for blocks
+    # that have all been delivered
+    def prune(self, rcv_nxt):
+        horizon = rcv_nxt - self.max_block * self.longest
+        offsets = self.offsets
+        while offsets and offsets[0] < horizon:
+            offset = heapq.heappop(offsets)
+            payload = self.segments.pop(offset, None)
+            if payload is not None:
+                self.ends.pop(offset + len(payload), None)
+        for start in [start for start, (end, count, parity) in self.pending.items() if end <= rcv_nxt]:
+            del self.pending[start]
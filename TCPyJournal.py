@@ -0,0 +1,110 @@
+"""
+TCPyJournal.py
+
+This module lets a TCPy transfer of a regular file pick up where it left off after the client dies - a
+timeout, a crash, the server going away for a while. The client journals how far into the file the server
+has ACK'ed to a small checkpoint file next to it, along with a random token naming the transfer. Run again
+with the same journal, the client offers the token in its SYN (see TCPyPacket.resume_option) and a server
+still holding the partial output answers with the offset it has, rounded down to RESUME_UNIT - the client
+sends only the rest of the file from there. A server that doesn't answer gets the whole file again.
+
+The journal is a single line of JSON, replaced whole on every write so a crash mid-write never leaves it
+half written. The send loop only records the latest offset; a background thread writes it out at most every
+JOURNAL_INTERVAL seconds, so the disk never holds up sending. A file changed since the journal was written
+(different size or modification time) starts a new transfer under a new token.
+"""
+import json
+import os
+import threading
+
+# seconds between journal writes while the transfer is running
+JOURNAL_INTERVAL = 1.0
+# resume offsets are exchanged in these units, so 32 bits cover files up to 4 TiB
+RESUME_UNIT = 1024
+# default journal name, after the file being sent
+JOURNAL_SUFFIX = '.tcpy-journal'
+
+
+# returns the journal path for a file unless one is given
+def journal_path(filename, path=None):
+    return path or filename + JOURNAL_SUFFIX
+
+
+class TCPyJournal:
+
+    def __init__(self, path, filename):
+        self.path = path
+        info = os.stat(filename)
+        self.identity = {'file': os.path.abspath(filename), 'size': info.st_size, 'mtime_ns': info.st_mtime_ns}
+        record = self.load()
+        if record is not None and all(record.get(key) == value for key, value in self.identity.items()):
+            self.token = record['token']
+            self.acked = record['acked']
+        else:
+            # a nonzero token - 0 never names a transfer
+            self.token = int.from_bytes(os.urandom(4), 'big') or 1
+            self.acked = 0
+        self.written = None     # offset last written out, None before the first write
+        self.pending = self.acked
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __repr__(self):
+        return "TCPyJournal({}, token={:08x}, acked={})".format(self.path, self.token, self.acked)
+
+    # the journal's record, None if there is none or it can't be read
+    def load(self):
+        try:
+            with open(self.path) as f:
+                record = json.loads(f.readline())
+            int(record['token']), int(record['acked'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return record
+
+    # starts writing the journal in the background
+    def start(self):
+        self.write()
+        self.thread = threading.Thread(target=self.run, name="tcpy-journal", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(JOURNAL_INTERVAL):
+            self.write()
+
+    # records the offset everything below has been ACK'ed - it is written out with the next batch
+    def update(self, offset):
+        self.pending = min(offset, self.identity['size'])
+
+    # writes the latest offset out, if it changed, through a temporary file renamed over the journal
+    def write(self):
+        with self.lock:
+            acked = self.pending
+            if acked == self.written:
+                return
+            record = dict(self.identity, token=self.token, acked=acked)
+            temp = self.path + '.tmp'
+            try:
+                with open(temp, 'w') as f:
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, self.path)
+            except OSError as e:
+                print("ERROR(journal): Unable to write {}: {}".format(self.path, e))
+                return
+            self.written = self.acked = acked
+
+    # stops the background writes - a finished transfer's journal is removed, otherwise the last offset is kept
+    def close(self, done=False):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if done:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        else:
+            self.write()
@@ -0,0 +1,108 @@
+"""
+TCPyPacer.py
+
+This module spreads the TCPy client's packets out over the round trip instead of sending each window
+opening back to back at line rate, which overflows shallow switch buffers and the receiver's socket
+queue. TCPyPacer is a token bucket: tokens (bytes) accrue at the pacing rate up to a small burst, and a new
+packet only goes out once there are tokens for it - otherwise the client waits the time the bucket needs
+to refill, still handling ACKs and timers meanwhile.
+
+The rate is either fixed, or follows the congestion window like Linux's pacing does - cwnd / SRTT scaled
+by SLOW_START_GAIN while cwnd is below ssthresh, so slow start can still double the window every RTT, and
+by CONGESTION_AVOIDANCE_GAIN after that.
+
+Retransmissions aren't paced, they go out as soon as a loss or timeout is detected.
+"""
+
+# rate multipliers for cwnd / SRTT (Linux tcp_pacing_ss_ratio and tcp_pacing_ca_ratio)
+SLOW_START_GAIN = 2.0
+CONGESTION_AVOIDANCE_GAIN = 1.2
+# the bucket holds at least this many segments, or this many seconds of sending at the rate
+BURST_SEGMENTS = 2
+BURST_TIME = 0.001
+# rate suffixes accepted by parse_rate
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+# parses a pacing rate in bytes per second with an optional K/M/G suffix - 'auto' (None) follows the window
+def parse_rate(text):
+    text = text.strip().upper()
+    if text == 'AUTO':
+        return None
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    rate = float(text[:len(text) - len(unit)]) * UNITS[unit]
+    if rate <= 0:
+        raise ValueError("pacing rate must be positive")
+    return rate
+
+
+class TCPyPacer:
+
+    def __init__(self, rate=None):
+        self.fixed_rate = rate
+        self.rate = rate            # bytes per second, None until an automatic rate has an RTT to go on
+        self.capacity = 0
+        self.tokens = 0
+        self.last_time = None
+        self.blocked_since = None   # when the packet now waiting for tokens was first held back
+        # how much pacing held packets back
+        self.packets = 0
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def __repr__(self):
+        return "TCPyPacer(rate={})".format('auto' if self.fixed_rate is None else int(self.fixed_rate))
+
+    # sets the rate for the current congestion window and RTT estimate, and the burst the bucket holds
+    def update(self, cwnd, ssthresh, srtt, mss):
+        if self.fixed_rate is None:
+            if not srtt:
+                self.rate = None
+                return
+            gain = SLOW_START_GAIN if cwnd < ssthresh else CONGESTION_AVOIDANCE_GAIN
+            self.rate = gain * cwnd / srtt
+        self.capacity = max(BURST_SEGMENTS * mss, self.rate * BURST_TIME)
+
+    # seconds until a packet of size bytes may be sent, 0 if it can go now
+    def delay(self, size, current_time):
+        if self.rate is None:
+            return 0
+        if self.last_time is None:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (current_time - self.last_time) * self.rate)
+        self.last_time = current_time
+        # packets bigger than the whole bucket only have to wait for it to fill
+        needed = min(size, self.capacity)
+        if self.tokens >= needed:
+            return 0
+        if self.blocked_since is None:
+            self.blocked_since = current_time
+        return (needed - self.tokens) / self.rate
+
+    # takes a sent packet's tokens, returning how long pacing held it back
+    def sent(self, size, current_time):
+        self.packets += 1
+        if self.rate is not None:
+            self.tokens -= size
+        if self.blocked_since is None:
+            return 0
+        delay = current_time - self.blocked_since
+        self.blocked_since = None
+        self.delayed += 1
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+        return delay
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'packets': self.packets,
+            'delayed': self.delayed,
+            'total_delay': self.total_delay,
+            'mean_delay': self.total_delay / self.delayed if self.delayed else 0.0,
+            'max_delay': self.max_delay,
+        }
@@ -18,45 +18,121 @@ of RFC 793 matching the following format:
 --------------------------------------------------------
 |   Checksum (16 bits)      |      Urgent Pointer(16)  |
 --------------------------------------------------------
-|             Options (24 bits)      | Padding (8 bits)|
+|     Options (0 - 40 bytes, padded to 32 bits)        |  * MSS, window scale, SACK, timestamps
 --------------------------------------------------------
-|                 Data (up to 1448 bytes)              |
+|           Data (up to the negotiated MSS)            |
 --------------------------------------------------------
 """
-import sys
-import crccheck.checksum as cs
-import bitstring as bs
 import socket
-from bitstring import BitArray
-from bitstring import BitStream
+import struct
+
+# the fixed 20 byte header: ports, sequence and ack numbers, then the offset byte (offset in the
+# upper 4 bits, upper reserved bits below it), the reserved/flags byte, window, checksum and urgent pointer
+HEADER = struct.Struct('!HHIIBBHHH')
+HEADER_LEN = HEADER.size
+CHECKSUM_FIELD = struct.Struct('!H')
+CHECKSUM_OFFSET = 16
+SEQ_ACK = struct.Struct('!ii')
+SEQ_PAIR = struct.Struct('!II')
+OPT_SHORT = struct.Struct('!H')
+SEQ_MOD = 2**32
+SEQ_MASK = SEQ_MOD - 1
+
+# flag bits within the reserved/flags byte
+FLAG_URG = 0x20
+FLAG_ACK = 0x10
+FLAG_PSH = 0x08
+FLAG_RST = 0x04
+FLAG_SYN = 0x02
+FLAG_FIN = 0x01
+
+# option kinds
+OPT_EOL = 0
+OPT_NOP = 1
+OPT_MSS = 2             # RFC 793/9293, SYN only - largest segment payload the sender of the option accepts
+OPT_WSCALE = 3          # RFC 7323, SYN only - shift applied to every later window field from the sender
+OPT_SACK_PERM = 4       # RFC 2018, SYN only
+OPT_SACK = 5            # RFC 2018, up to 4 blocks of (left edge, right edge)
+OPT_TIMESTAMP = 8       # RFC 7323, (TSval, TSecr)
+OPT_EXPERIMENT = 253    # RFC 4727/6994 experimental option, told apart by a 16-bit ExID after the length
+EXID_SESSION = 0x5459   # SYN only - the data is a session of framed files (see TCPySession)
+EXID_FEC = 0x4645       # in a SYN, FEC with blocks of up to n segments - otherwise marks a parity segment (see TCPyFec)
+EXID_RESUME = 0x5253    # SYN only - the client's transfer token, and the server's resume offset (see TCPyJournal)
+MAX_OPTIONS_LEN = 40
+# TCPy segments travel in UDP over IPv4, so a segment's payload is the path MTU less those headers and
+# its own - MAX_MSS is the most a single datagram can carry
+IP_UDP_OVERHEAD = 28
+MAX_MSS = 65535 - IP_UDP_OVERHEAD - HEADER_LEN
+MAX_SACK_BLOCKS = 4
+MAX_WSCALE = 14
+# the timestamp option is always written first, NOP-aligned, so its values sit at a fixed place in the packet
+TIMESTAMP_LEN = 12
+TSVAL_OFFSET = HEADER_LEN + 4
+# FEC option values after the ExID - (block size) in a SYN, (block length, segment count) in a parity segment
+FEC_OFFER = struct.Struct('!H')
+FEC_PARITY = struct.Struct('!IH')
+# a parity option with its NOPs, which parity segments carry on top of the timestamps
+FEC_PARITY_LEN = 4 + 2 + FEC_PARITY.size
+# resume option value after the ExID - the transfer token in a SYN, the offset in RESUME_UNITs in a SYN/ACK
+RESUME = struct.Struct('!I')
+
+
+# compact, read-only view of a received segment - replaces the old per-packet dictionary
+class TCPySegment:
+    __slots__ = ('S_PORT', 'D_PORT', 'SEQ_NUM', 'ACK_NUM', 'OFFSET', 'ACK', 'SYN', 'FIN', 'WINDOW', 'DATA',
+                 'MSS', 'WSCALE', 'SACK_PERM', 'SACK', 'TS', 'SESSION', 'FEC', 'PARITY', 'RESUME')
+
+    def __init__(self, s_port, d_port, seq_num, ack_num, offset, flags, window, data):
+        self.S_PORT = s_port
+        self.D_PORT = d_port
+        self.SEQ_NUM = seq_num
+        self.ACK_NUM = ack_num
+        self.OFFSET = offset
+        self.ACK = bool(flags & FLAG_ACK)
+        self.SYN = bool(flags & FLAG_SYN)
+        self.FIN = bool(flags & FLAG_FIN)
+        self.WINDOW = window
+        self.DATA = data
+        self.MSS = None
+        self.WSCALE = None
+        self.SACK_PERM = False
+        self.SACK = ()
+        self.TS = None
+        self.SESSION = False
+        self.FEC = None
+        self.PARITY = None
+        self.RESUME = None
+
+    def __repr__(self):
+        return "TCPySegment(seq={}, ack={}, A={}, S={}, F={}, window={}, len={})".format(
+            self.SEQ_NUM, self.ACK_NUM, self.ACK, self.SYN, self.FIN, self.WINDOW, len(self.DATA))
 
 
 class TCPyPacket:
     TCP_PTCL = (6).to_bytes(1, byteorder="big")
 
+    # sums a buffer as big-endian 16-bit words modulo 2**16 - the same value crccheck's Checksum16 produced,
+    # including its habit of ignoring a trailing odd byte. Splitting the high and low bytes lets the two
+    # sums run over plain byte slices instead of a per-word Python loop
+    def sum16(buffer):
+        end = len(buffer) & ~1
+        return ((sum(buffer[0:end:2]) << 8) + sum(buffer[1:end:2])) & 0xFFFF
+
     # calcs and modifies the checksum field of an outgoing packet
-    def calc_checksum(packet, pseudo_header):
+    def calc_checksum(packet):
         # ensure checksum is 0'ed out
-        packet.overwrite(b'\x00\x00', 128)
-        cs_calc = cs.Checksum16()
-        cs_calc.process(packet.tobytes())
-        #cs_calc.process(pseudo_header)
-        checksum = cs_calc.finalbytes()
-        packet.overwrite(checksum, 128)
+        CHECKSUM_FIELD.pack_into(packet, CHECKSUM_OFFSET, 0)
+        #checksum would also cover create_pseudo_header(...) here
+        CHECKSUM_FIELD.pack_into(packet, CHECKSUM_OFFSET, TCPyPacket.sum16(packet))
 
     # validates checksum of incoming packets
     def valid_checksum(source_address, dest_address, bytes_packet):
-        bin_packet = BitStream(bytes=bytes_packet)
-        length = len(bin_packet) % 8
-        checksum = bin_packet[128:144].bytes
-        pseudo_header = TCPyPacket.create_pseudo_header(source_address, dest_address, length)
-        bin_packet.overwrite(b'\x00\x00', 128)
-        cs_calc = cs.Checksum16()
-        cs_calc.process(bin_packet.tobytes())
-        #cs_calc.process(pseudo_header)
-        if checksum != cs_calc.finalbytes():
+        if len(bytes_packet) < HEADER_LEN:
             return False
-        return True
+        checksum = CHECKSUM_FIELD.unpack_from(bytes_packet, CHECKSUM_OFFSET)[0]
+        # one pass over the packet as received, then back the checksum field out of the total
+        # instead of zeroing it in a copy
+        return (TCPyPacket.sum16(bytes_packet) - checksum) & 0xFFFF == checksum
 
     # used to create the TCP pseudo-header to prevent misrouting, not used
     def create_pseudo_header(source_address, dest_address, length):
@@ -68,72 +144,161 @@ class TCPyPacket:
         pseudo_header += length.to_bytes(2, byteorder="big")
         return pseudo_header
 
-    # unpacks received packets and fills a dictionary with their relevant values for querying
+    # unpacks received packets into a TCPySegment for querying, None if the packet is invalid
     def unpack_packet(source_address, dest_address, bytes_packet):
-        packet_binary = BitStream(bytes=bytes_packet)
         if not TCPyPacket.valid_checksum(source_address, dest_address, bytes_packet):
             return None
-        packet_dict = {
-            'S_PORT' : packet_binary[0:16].uint,
-            'D_PORT' : packet_binary[16:32].uint,
-            'SEQ_NUM': packet_binary[32:64].uint,
-            'ACK_NUM': packet_binary[64:96].uint,
-            'OFFSET' : packet_binary[96:100].uint,
-            'ACK'    : packet_binary[107],
-            'SYN'    : packet_binary[110],
-            'FIN'    : packet_binary[111],
-            'WINDOW' : packet_binary[112:128].uint,
-        }
-        return packet_dict
+        view = memoryview(bytes_packet)
+        s_port, d_port, seq_num, ack_num, offset_byte, flags, window, checksum, urgent = HEADER.unpack_from(view)
+        offset = offset_byte >> 4
+        segment = TCPySegment(s_port, d_port, seq_num, ack_num, offset, flags, window, view[offset * 4:])
+        if offset > 5:
+            TCPyPacket.parse_options(segment, view[HEADER_LEN:offset * 4])
+        return segment
+
+    # fills in the option fields of a segment from its options bytes, ignoring kinds it doesn't know
+    def parse_options(segment, options):
+        i = 0
+        end = len(options)
+        while i < end:
+            kind = options[i]
+            if kind == OPT_EOL:
+                break
+            if kind == OPT_NOP:
+                i += 1
+                continue
+            # every other option is kind, length, value - stop at anything malformed
+            if i + 1 >= end or options[i + 1] < 2 or i + options[i + 1] > end:
+                break
+            length = options[i + 1]
+            if kind == OPT_SACK:
+                segment.SACK = [SEQ_PAIR.unpack_from(options, j) for j in range(i + 2, i + length - 7, 8)]
+            elif kind == OPT_TIMESTAMP and length == 10:
+                segment.TS = SEQ_PAIR.unpack_from(options, i + 2)
+            elif kind == OPT_MSS and length == 4:
+                segment.MSS = OPT_SHORT.unpack_from(options, i + 2)[0]
+            elif kind == OPT_WSCALE and length == 3:
+                # RFC 7323 - shifts above 14 are treated as 14
+                segment.WSCALE = min(options[i + 2], MAX_WSCALE)
+            elif kind == OPT_SACK_PERM:
+                segment.SACK_PERM = True
+            elif kind == OPT_EXPERIMENT and length >= 4:
+                exid = OPT_SHORT.unpack_from(options, i + 2)[0]
+                if exid == EXID_SESSION:
+                    segment.SESSION = True
+                elif exid == EXID_FEC and length == 4 + FEC_OFFER.size:
+                    segment.FEC = FEC_OFFER.unpack_from(options, i + 4)[0]
+                elif exid == EXID_FEC and length == 4 + FEC_PARITY.size:
+                    segment.PARITY = FEC_PARITY.unpack_from(options, i + 4)
+                elif exid == EXID_RESUME and length == 4 + RESUME.size:
+                    segment.RESUME = RESUME.unpack_from(options, i + 4)[0]
+            i += length
+
+    # MSS option for a SYN
+    def mss_option(mss):
+        return bytes((OPT_MSS, 4)) + OPT_SHORT.pack(mss)
+
+    # NOP-aligned window scale option for a SYN
+    def window_scale_option(shift):
+        return bytes((OPT_NOP, OPT_WSCALE, 3, min(shift, MAX_WSCALE)))
+
+    # NOP-aligned timestamps option - must come first in the options for restamp() to find it
+    def timestamp_option(tsval, tsecr):
+        return bytes((OPT_NOP, OPT_NOP, OPT_TIMESTAMP, 10)) + SEQ_PAIR.pack(tsval & SEQ_MASK, tsecr & SEQ_MASK)
+
+    # rewrites the TSval of a packet built with a leading timestamp_option(), e.g. before it is retransmitted.
+    # Only the two changed words are swapped in the checksum (RFC 1624), so this costs the same for any payload
+    def restamp(packet, tsval):
+        old = TCPyPacket.sum16(packet[TSVAL_OFFSET:TSVAL_OFFSET + 4])
+        SEQ_PAIR.pack_into(packet, TSVAL_OFFSET, tsval & SEQ_MASK, SEQ_PAIR.unpack_from(packet, TSVAL_OFFSET)[1])
+        new = TCPyPacket.sum16(packet[TSVAL_OFFSET:TSVAL_OFFSET + 4])
+        checksum = CHECKSUM_FIELD.unpack_from(packet, CHECKSUM_OFFSET)[0]
+        CHECKSUM_FIELD.pack_into(packet, CHECKSUM_OFFSET, (checksum - old + new) & 0xFFFF)
+
+    # experimental option for a SYN announcing a session of framed files
+    def session_option():
+        return bytes((OPT_EXPERIMENT, 4)) + OPT_SHORT.pack(EXID_SESSION)
+
+    # NOP-aligned experimental option for a SYN offering (or accepting) FEC with blocks of up to block_size segments
+    def fec_option(block_size):
+        return (bytes((OPT_NOP, OPT_NOP, OPT_EXPERIMENT, 4 + FEC_OFFER.size)) + OPT_SHORT.pack(EXID_FEC) +
+                FEC_OFFER.pack(block_size))
+
+    # NOP-aligned experimental option marking a parity segment - the XOR of the count segments in the block_len
+    # bytes from its sequence number
+    def parity_option(block_len, count):
+        return (bytes((OPT_NOP, OPT_NOP, OPT_EXPERIMENT, 4 + FEC_PARITY.size)) + OPT_SHORT.pack(EXID_FEC) +
+                FEC_PARITY.pack(block_len, count))
+
+    # experimental option for a SYN naming the transfer to resume, or for a SYN/ACK giving the offset to resume
+    # from - 8 bytes, so it needs no NOPs
+    def resume_option(value):
+        return bytes((OPT_EXPERIMENT, 4 + RESUME.size)) + OPT_SHORT.pack(EXID_RESUME) + RESUME.pack(value)
+
+    # NOP-aligned SACK-permitted option for a SYN
+    def sack_permitted_option():
+        return bytes((OPT_NOP, OPT_NOP, OPT_SACK_PERM, 2))
+
+    # NOP-aligned SACK option reporting up to max_blocks (left edge, right edge) blocks - only 3 fit
+    # alongside a timestamps option
+    def sack_option(blocks, max_blocks = MAX_SACK_BLOCKS):
+        blocks = blocks[:max_blocks]
+        option = bytearray((OPT_NOP, OPT_NOP, OPT_SACK, 2 + 8 * len(blocks)))
+        for left, right in blocks:
+            option += SEQ_PAIR.pack(left & SEQ_MASK, right & SEQ_MASK)
+        return bytes(option)
+
+    # turns a 32-bit sequence number from the wire back into the unwrapped number closest to reference
+    def unwrap_seq(reference, seq_num):
+        return reference + ((seq_num - reference + 2**31) & SEQ_MASK) - 2**31
 
     # returns syn/ack'ed seq number and ack number if SYN and ACK set, else returns (False, False)
     def check_synack(packet_bytes):
-        packet_binary = BitStream(bytes=packet_bytes)
-        try:
-            if packet_binary[110] and packet_binary[107]:
-                seq_binary = packet_binary[32:64]
-                ack_binary = packet_binary[64:96]
-                seq_num = seq_binary.int
-                ack_num = ack_binary.int
-                return (seq_num, ack_num)
-            return (False, False)
-        except:
+        if len(packet_bytes) < HEADER_LEN:
             return (False, False)
+        flags = packet_bytes[13]
+        if flags & FLAG_SYN and flags & FLAG_ACK:
+            return SEQ_ACK.unpack_from(packet_bytes, 4)
+        return (False, False)
 
     # checks to see if packet is a FIN packet
     def is_fin(packet_bytes):
-        packet_binary = BitStream(bytes=packet_bytes)
-        return packet_binary[111]
+        return bool(packet_bytes[13] & FLAG_FIN)
 
     # packages package from use-to-use numbers into their binary form
+    # (sequence and ack numbers are taken modulo 2**32, options are padded out to a multiple of 4 bytes).
+    # payload_sum is data's sum16 if the caller already knows it, e.g. from a TCPyChecksumIndex, so only the
+    # header is summed here. With header_only the data isn't copied in - the header (checksum covering the
+    # data) is returned alone, for sending the two with one scatter-gather sendmsg()
     def package_packet(source_address, dest_address, source_port, dest_port, seq_num, ack_num = 0, 
                        offset = 5, ack = False, syn = False, fin = False, 
-                       window = 0, data = False):
-        packet_dict = {'source_port': source_port, 'dest_port': dest_port,
-                       'seq_num': seq_num,
-                       'ack_num': ack_num,
-                       'offset': offset, 'reserved': 0, 'U': False, 'A': ack, 'P': False,  'R': False, 'S': syn, 'F': fin, 'window': window,
-                       'checksum': b'\x00\x00', 'urgent': 0,
-        }
-
-        pack_format  = 'uint:16=source_port, uint:16=dest_port,'
-        pack_format += ' uint:32=seq_num,'
-        pack_format += ' uint:32=ack_num,'
-        pack_format += ' uint:4=offset, uint:6=reserved, bool=U, bool=A, bool=P, bool=R, bool=S, bool=F, uint:16=window,'
-        pack_format += ' bytes:2=checksum, uint:16=urgent,'
-        header_binary = bs.pack(pack_format, **packet_dict)
-        # combine the header and the data binary
-        if data and len(data) > 0:
-            data_binary = BitStream(bytes=data)
-            packet = header_binary + data_binary
-        # no data
-        else:
-            packet = header_binary
-        length = len(packet) % 8
-        pseudo_header = TCPyPacket.create_pseudo_header(source_address, dest_address, length)
+                       window = 0, data = False, options = b'', payload_sum = None, header_only = False):
+        flags = (FLAG_ACK if ack else 0) | (FLAG_SYN if syn else 0) | (FLAG_FIN if fin else 0)
+        data_len = len(data) if data else 0
+        header_len = HEADER_LEN
+        if options:
+            if len(options) > MAX_OPTIONS_LEN:
+                raise ValueError("{} bytes of options, at most {} fit in the header".format(len(options), MAX_OPTIONS_LEN))
+            options_len = (len(options) + 3) & ~3
+            header_len += options_len
+            offset = header_len // 4
+        # allocate the whole packet once and fill the header, options and data in place
+        packet = bytearray(header_len if header_only else header_len + data_len)
+        HEADER.pack_into(packet, 0, source_port, dest_port, seq_num & SEQ_MASK, ack_num & SEQ_MASK,
+                         offset << 4, flags, window, 0, 0)
+        if options:
+            packet[HEADER_LEN:HEADER_LEN + len(options)] = options
+        if header_only:
+            if payload_sum is None:
+                payload_sum = TCPyPacket.sum16(data) if data_len else 0
+        elif data_len:
+            packet[header_len:] = data
 
-
-        TCPyPacket.calc_checksum(packet, pseudo_header)
+        if payload_sum is None:
+            TCPyPacket.calc_checksum(packet)
+        else:
+            # the header is a whole number of words, so the payload's words line up with the packet's
+            CHECKSUM_FIELD.pack_into(packet, CHECKSUM_OFFSET,
+                                     (TCPyPacket.sum16(packet[:header_len]) + payload_sum) & 0xFFFF)
 
         return packet
-
@@ -0,0 +1,238 @@
+"""
+TCPyParallel.py
+
+One TCPyClient is held to a single core by the interpreter, so past a point building and handling packets
+in Python limits a transfer before the network does. This module splits a transfer across worker
+processes, each running its own client on its own source port (client port, client port + 1, ...):
+
+    stripe_file(path, workers)      - one large file cut into contiguous ranges, each sent as a range
+                                      frame the server writes into the file at its offset
+    spread_files(files, workers)    - many files dealt out so every worker has about as many bytes to send
+    TCPyParallelTransfer            - runs the workers, reports progress, retries failed shares - including
+                                      those of workers that died, e.g. killed or out of memory - and adds
+                                      the workers' results up
+
+Every worker sends its share as a session (see TCPySession), so ranges need a server that supports
+sessions. Progress is the bytes each worker has had ACK'ed, kept in shared memory the parent polls. Results
+count file data as bytes (and goodput), with what went on the wire, frame headers included, as wire_bytes.
+"""
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+
+from TCPySession import TCPySessionClient, TCPySessionFile, frame_header
+
+# ranges are at least this long, and start on this boundary so they map onto whole pages
+MIN_STRIPE = 1024 * 1024
+STRIPE_ALIGN = 64 * 1024
+# times a failed share is sent again before the transfer is given up on
+RETRIES = 1
+# seconds between progress lines, and between checks on the workers
+PROGRESS_INTERVAL = 1.0
+POLL_INTERVAL = 0.05
+
+# bytes ACK'ed so far per worker, shared with the parent - set in each worker process by init_worker
+progress = None
+
+
+# cuts a file into up to workers contiguous ranges, one share of a single range each
+def stripe_file(path, workers, name=None):
+    size = os.stat(path).st_size
+    name = name or os.path.basename(path)
+    workers = max(1, min(workers, size // MIN_STRIPE))
+    bounds = [0] + [size * i // workers // STRIPE_ALIGN * STRIPE_ALIGN for i in range(1, workers)] + [size]
+    return [[TCPySessionFile(path, name, end - start, start, size)] for start, end in zip(bounds, bounds[1:])]
+
+
+# deals files out to up to workers shares, the largest first to whichever share has the fewest bytes so far
+def spread_files(files, workers):
+    shares = [[] for _ in range(max(1, min(workers, len(files))))]
+    loads = [0] * len(shares)
+    order = {file: i for i, file in enumerate(files)}
+    for file in sorted(files, key=lambda file: file.size, reverse=True):
+        i = loads.index(min(loads))
+        shares[i].append(file)
+        loads[i] += share_size([file])
+    # each share keeps the files in the order they were listed
+    return [sorted(share, key=order.get) for share in shares]
+
+
+# bytes a share puts on the wire - frame headers and data
+def share_size(share):
+    return sum(len(frame_header(file)) + file.size for file in share)
+
+
+# bytes of file data in a share
+def file_size(share):
+    return sum(file.size for file in share)
+
+
+def init_worker(shared):
+    global progress
+    progress = shared
+
+
+# a session client reporting its progress to the parent after every batch of ACKs
+class TCPyWorkerClient(TCPySessionClient):
+
+    def __init__(self, slot, *args, **kwargs):
+        self.slot = slot
+        super().__init__(*args, **kwargs)
+
+    def process_acks(self, packets):
+        TCPySessionClient.process_acks(self, packets)
+        progress[self.slot] = self.SEQ_VARS['SND.UNA'] - self.SEQ_VARS['ISS'] - 1
+
+
+# the result of a share before it is sent
+def share_result(slot, source_port, share):
+    return {'worker': slot, 'port': source_port, 'files': len(share), 'bytes': file_size(share),
+            'wire_bytes': share_size(share), 'ok': True}
+
+
+# sends one share from a worker process, returning what became of it - errors, including the client's own
+# exit on a fatal error, are reported back rather than raised
+def send_share(slot, dest_address, source_port, dest_port, share, congestion, mss, pacing, fec, stats):
+    telemetry = None
+    if stats:
+        from TCPyTelemetry import TCPyTelemetry
+        telemetry = TCPyTelemetry()
+    result = share_result(slot, source_port, share)
+    start_time = time.monotonic()
+    try:
+        TCPyWorkerClient(slot, dest_address, source_port, dest_port, share, congestion, mss, telemetry,
+                         pacing, fec).send()
+    except SystemExit:
+        result.update(ok=False, error="client aborted")
+    except Exception as e:
+        result.update(ok=False, error="{}: {}".format(type(e).__name__, e))
+    result['elapsed'] = time.monotonic() - start_time
+    result['goodput'] = result['bytes'] / result['elapsed'] if result['ok'] and result['elapsed'] > 0 else None
+    if telemetry is not None:
+        result['counters'] = telemetry.summary()['counters']
+    return result
+
+
+# runs in a worker process of its own - sends a share and its result back to the parent over conn
+def run_worker(conn, shared, *args):
+    init_worker(shared)
+    conn.send(send_share(*args))
+    conn.close()
+
+
+class TCPyParallelTransfer:
+
+    def __init__(self, dest_address, source_port, dest_port, shares, congestion='reno', mss=None, pacing=None,
+                 fec=None, stats=False):
+        self.DEST_ADDRESS = dest_address
+        self.SOURCE_PORT = source_port
+        self.DEST_PORT = dest_port
+        self.shares = [share for share in shares if share]
+        self.congestion = congestion
+        self.MSS_LIMIT = mss
+        self.PACING = pacing
+        self.FEC = fec
+        self.stats = stats
+        self.results = []
+        self.elapsed = None
+
+    def __repr__(self):
+        return "{} files in {} flows".format(sum(len(share) for share in self.shares), len(self.shares))
+
+    # the arguments of send_share for a worker
+    def share_args(self, slot):
+        return (slot, self.DEST_ADDRESS, self.SOURCE_PORT + slot, self.DEST_PORT, self.shares[slot],
+                self.congestion, self.MSS_LIMIT, self.PACING, self.FEC, self.stats)
+
+    # starts a worker process sending a share, returns it with the end of the pipe its result comes back on
+    def start_worker(self, slot, shared):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_worker, args=(sender, shared) + self.share_args(slot),
+                                          name="tcpy-worker-{}".format(slot), daemon=True)
+        process.start()
+        # only the worker holds the sending end now, so the pipe reads as closed if it dies
+        sender.close()
+        return process, receiver
+
+    # the result of a worker that is done, None while it is still running - a worker that died before sending
+    # one (killed, out of memory, crashed) gets a failed result
+    def worker_result(self, slot, process, receiver):
+        if not receiver.poll() and process.is_alive():
+            return None
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = None
+        process.join()
+        receiver.close()
+        if result is None:
+            result = share_result(slot, self.SOURCE_PORT + slot, self.shares[slot])
+            result.update(ok=False, error="worker exited with code {}".format(process.exitcode), elapsed=None,
+                          goodput=None)
+        return result
+
+    # runs every share on its own worker until all are done or out of retries, returns the summary
+    def send(self):
+        workers = len(self.shares)
+        total = sum(share_size(share) for share in self.shares)
+        print("SENDING: {} To: {}:{}".format(self, self.DEST_ADDRESS, self.DEST_PORT))
+        shared = multiprocessing.Array('q', workers, lock=False)
+        attempts = [1] * workers
+        results = {}
+        start_time = time.monotonic()
+        last_report = start_time
+        pending = {slot: self.start_worker(slot, shared) for slot in range(workers)}
+        try:
+            while pending:
+                # wakes as soon as a worker sends its result or exits, or to report progress
+                multiprocessing.connection.wait([handle for process, receiver in pending.values()
+                                                 for handle in (receiver, process.sentinel)], POLL_INTERVAL)
+                for slot, (process, receiver) in list(pending.items()):
+                    result = self.worker_result(slot, process, receiver)
+                    if result is None:
+                        continue
+                    del pending[slot]
+                    if not result['ok'] and attempts[slot] <= RETRIES:
+                        print("ERROR(worker {}): {}, retrying.".format(slot, result['error']))
+                        attempts[slot] += 1
+                        shared[slot] = 0
+                        pending[slot] = self.start_worker(slot, shared)
+                        continue
+                    result['attempts'] = attempts[slot]
+                    results[slot] = result
+                current_time = time.monotonic()
+                if pending and current_time - last_report >= PROGRESS_INTERVAL:
+                    last_report = current_time
+                    acked = sum(shared)
+                    print("Progress: {}/{} bytes ({:.1f}%), {:.2f} MB/s over {} flows".format(
+                        acked, total, 100 * acked / total if total else 100,
+                        acked / (current_time - start_time) / 1e6, len(pending)))
+        finally:
+            for process, receiver in pending.values():
+                process.terminate()
+                process.join()
+        self.elapsed = time.monotonic() - start_time
+        self.results = [results[slot] for slot in range(workers)]
+        return self.summary()
+
+    # the workers' results added up - ok only if every share made it
+    def summary(self):
+        sent = sum(result['bytes'] for result in self.results if result['ok'])
+        summary = {
+            'flows': len(self.results),
+            'ok': all(result['ok'] for result in self.results),
+            'bytes': sent,
+            'wire_bytes': sum(result['wire_bytes'] for result in self.results if result['ok']),
+            'elapsed': self.elapsed,
+            'goodput': sent / self.elapsed if self.elapsed else None,
+            'failed': [result['worker'] for result in self.results if not result['ok']],
+            'workers': self.results,
+        }
+        if self.stats:
+            counters = {}
+            for result in self.results:
+                for name, value in result.get('counters', {}).items():
+                    counters[name] = counters.get(name, 0) + value
+            summary['counters'] = counters
+        return summary
@@ -0,0 +1,173 @@
+"""
+TCPyScoreboard.py
+
+This module tracks the TCPy client's in-flight segments. Segments are kept in send order - which is
+also sequence order, since retransmissions reuse the original segment - so they form a sorted list of
+intervals that can be searched with bisect:
+
+    ack(ack_num)        - cumulative ACK, everything ending at or before ack_num is done
+    sack(left, right)   - selective ACK (RFC 2018 block, or a legacy per-segment ACK), O(log n) to find,
+                          then only the segments in it not SACK'ed already are visited
+    detect_losses()     - RFC 6675 style loss detection: a segment is lost once DUP_THRESH segments
+                          above it have been SACK'ed, which is what three duplicate ACKs report
+
+The oldest unACK'ed segment is found through a head index rather than a min() over everything in
+flight, and both the head and the loss scan only ever move forward. SACK blocks repeat what earlier ones
+reported (a receiver sends [hole end, highest received) on every ACK after a hole), so SACK'ed segments
+point past themselves to the next one that isn't - a union-find with path compression - and a block only
+costs its new segments. The cost per ACK stays logarithmic however large the window gets.
+"""
+import bisect
+
+DUP_THRESH = 3
+# the lists are only trimmed once this many finished segments have built up in front of the head
+COMPACT_THRESHOLD = 1024
+
+
+# one in-flight segment and the header it was sent with - the payload is read from the source again when
+# it has to be resent, so only headers are held for the whole window
+class TCPyInflight:
+    __slots__ = ('start', 'end', 'header', 'sent_time', 'retransmits', 'sacked')
+
+    def __init__(self, start, end, header, sent_time):
+        self.start = start
+        self.end = end
+        self.header = header
+        self.sent_time = sent_time
+        self.retransmits = 0
+        self.sacked = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return "TCPyInflight({}-{}, retransmits={}, sacked={})".format(
+            self.start, self.end, self.retransmits, self.sacked)
+
+
+class TCPyScoreboard:
+
+    def __init__(self, dup_thresh=DUP_THRESH):
+        self.dup_thresh = dup_thresh
+        self.starts = []            # start of every tracked segment, ascending
+        self.segments = []          # TCPyInflight for each entry of starts
+        self.skip = []              # for each entry, itself if unSACK'ed, otherwise an index past it to look at
+        self.head = 0               # index of the oldest segment not yet cumulatively ACK'ed
+        self.sacked = 0             # SACK'ed segments at or after head
+        self.in_flight = 0          # bytes neither ACK'ed nor SACK'ed
+        self.scan = 0               # index the loss scan resumes from
+        self.sacked_below_scan = 0  # SACK'ed segments between head and scan
+
+    def __len__(self):
+        return len(self.starts) - self.head
+
+    # start of the oldest segment not yet cumulatively ACK'ed (SND.UNA), None if nothing is outstanding
+    @property
+    def una(self):
+        return self.starts[self.head] if self.head < len(self.starts) else None
+
+    # records a newly sent segment, which must come after everything already tracked
+    def add(self, start, end, header, sent_time):
+        segment = TCPyInflight(start, end, header, sent_time)
+        self.skip.append(len(self.starts))
+        self.starts.append(start)
+        self.segments.append(segment)
+        self.in_flight += end - start
+        return segment
+
+    # returns the outstanding segment starting at start, or None
+    def find(self, start):
+        i = bisect.bisect_left(self.starts, start, self.head)
+        if i < len(self.starts) and self.starts[i] == start:
+            return self.segments[i]
+        return None
+
+    # cumulative ACK - retires every segment ending at or before ack_num, and with skip_sacked (used when
+    # ACKs are per-segment rather than cumulative) any SACK'ed segments that reach the head.
+    # Returns the segments that weren't already SACK'ed, i.e. newly ACK'ed data
+    def ack(self, ack_num, skip_sacked=False):
+        acked = []
+        segments = self.segments
+        while self.head < len(segments):
+            segment = segments[self.head]
+            if segment.sacked:
+                if segment.end > ack_num and not skip_sacked:
+                    break
+                self.sacked -= 1
+                if self.head < self.scan:
+                    self.sacked_below_scan -= 1
+            elif segment.end <= ack_num:
+                self.in_flight -= segment.end - segment.start
+                acked.append(segment)
+            else:
+                break
+            self.head += 1
+        if self.scan < self.head:
+            self.scan = self.head
+            self.sacked_below_scan = 0
+        if self.head > COMPACT_THRESHOLD and self.head * 2 > len(segments):
+            self.compact()
+        return acked
+
+    # selective ACK of [left, right) - marks every segment inside it and returns the newly SACK'ed ones
+    def sack(self, left, right):
+        sacked = []
+        starts = self.starts
+        skip = self.skip
+        i = self.next_unsacked(bisect.bisect_left(starts, left, self.head))
+        while i < len(starts) and starts[i] < right:
+            segment = self.segments[i]
+            if segment.end <= right:
+                segment.sacked = True
+                self.sacked += 1
+                self.in_flight -= segment.end - segment.start
+                if i < self.scan:
+                    self.sacked_below_scan += 1
+                sacked.append(segment)
+                skip[i] = i + 1
+            i = self.next_unsacked(i + 1)
+        return sacked
+
+    # index of the first unSACK'ed segment at or after i (len(starts) if there is none), shortening the path
+    # to it for every SACK'ed segment passed on the way
+    def next_unsacked(self, i):
+        skip = self.skip
+        end = i
+        while end < len(skip) and skip[end] != end:
+            end = skip[end]
+        while i < end:
+            following = skip[i]
+            skip[i] = end
+            i = following
+        return end
+
+    # selective ACK of the single segment ending at end - how a receiver that ACKs every segment reports it
+    def sack_segment(self, end):
+        i = bisect.bisect_left(self.starts, end, self.head) - 1
+        if i >= self.head and self.segments[i].end == end:
+            return self.sack(self.starts[i], end)
+        return []
+
+    # returns the unSACK'ed segments that now have at least dup_thresh SACK'ed segments above them. Each
+    # segment is only reported once - if its retransmission is lost too, the retransmission timer covers it
+    def detect_losses(self):
+        lost = []
+        segments = self.segments
+        while self.scan < len(segments) and self.sacked - self.sacked_below_scan >= self.dup_thresh:
+            segment = segments[self.scan]
+            if segment.sacked:
+                self.sacked_below_scan += 1
+            else:
+                lost.append(segment)
+            self.scan += 1
+        return lost
+
+    # drops the finished segments in front of the head
+    def compact(self):
+        head = self.head
+        del self.starts[:head]
+        del self.segments[:head]
+        # every entry points at or past itself, so none point into the part dropped
+        self.skip = [i - head for i in self.skip[head:]]
+        self.scan -= self.head
+        self.head = 0
@@ -0,0 +1,317 @@
+"""
+TCPySession.py
+
+This module sends many files over one TCPy connection - one handshake, one socket and one congestion
+window for the lot, instead of a connection (and for the command line, an interpreter) per file. The
+files are sent back to back as a single stream in which each one is framed by a header:
+
+    --------------------------------------------------------
+    |                   Magic 'TCPy' (32 bits)             |
+    --------------------------------------------------------
+    |   Name Length (16 bits)   |                          |
+    ----------------------------                           |
+    |                  File Size (64 bits)                 |
+    --------------------------------------------------------
+    |           Name (UTF-8, '/' separated path)           |
+    --------------------------------------------------------
+    |                  File Data (File Size bytes)         |
+    --------------------------------------------------------
+
+A range frame (magic 'TCPr') carries one part of a file instead, with a 64-bit offset after the size that
+says where in the file the data goes and then the 64-bit size of the whole file, which the receiver cuts the
+file to - how TCPyParallel stripes one file across several connections.
+
+The SYN carries an experimental option asking for session framing. A server that answers it gets the
+framed stream; one that doesn't (e.g. the course server) is sent the first file on this connection and
+every other file on its own connection afterwards.
+
+    list_files(...)         - the files of a directory, glob pattern, manifest or list of paths
+    TCPySessionSource       - the framed stream as a TCPySource, reading each file only as it is sent
+    TCPySessionClient       - TCPyClient sending a session
+    TCPyFrameReader         - receiver side, splitting the stream back into files
+"""
+import bisect
+import collections
+import glob
+import hashlib
+import os
+import struct
+import sys
+
+from TCPyPacket import TCPyPacket as pkt
+from TCPySource import TCPyMmapSource, open_source
+from tcp_client import TCPyClient
+
+MAGIC = b'TCPy'
+FRAME = struct.Struct('!4sHQ')
+RANGE_MAGIC = b'TCPr'
+RANGE_FRAME = struct.Struct('!4sHQQQ')
+FRAMES = {MAGIC: FRAME, RANGE_MAGIC: RANGE_FRAME}
+# files up to this size are read whole instead of mapped
+SMALL_FILE = 64 * 1024
+
+# a file to send - or with offset, the size bytes of it starting there, out of a file of total bytes
+TCPySessionFile = collections.namedtuple('TCPySessionFile', ('path', 'name', 'size', 'offset', 'total'),
+                                         defaults=(None, None))
+
+
+# returns the files to send, named relative to the deepest directory containing all of them
+def session_files(paths, base=None):
+    paths = [path for path in paths if os.path.isfile(path)] if base is not None else list(paths)
+    if not paths:
+        return []
+    if base is None:
+        base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    files = []
+    for path in paths:
+        name = os.path.relpath(os.path.abspath(path), base).replace(os.sep, '/')
+        files.append(TCPySessionFile(path, name, os.stat(path).st_size))
+    return files
+
+
+# lists the files of a directory (recursively), a glob pattern, a manifest with one path per line ('-' for
+# stdin, blank lines and # comments skipped) or a list of paths, in a stable order
+def list_files(directory=None, pattern=None, manifest=None, paths=None):
+    if directory is not None:
+        found = []
+        for root, dirs, names in os.walk(directory):
+            dirs.sort()
+            found.extend(os.path.join(root, name) for name in sorted(names))
+        return session_files(found, os.path.abspath(directory))
+    if pattern is not None:
+        return session_files([path for path in sorted(glob.glob(pattern, recursive=True)) if os.path.isfile(path)])
+    if manifest is not None:
+        lines = sys.stdin if manifest == '-' else open(manifest)
+        try:
+            paths = [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+    return session_files(paths or [])
+
+
+# returns the frame header for a file, or a range frame header for part of one
+def frame_header(file):
+    name = file.name.encode()
+    if file.offset is None:
+        return FRAME.pack(MAGIC, len(name), file.size) + name
+    total = file.total if file.total is not None else file.offset + file.size
+    return RANGE_FRAME.pack(RANGE_MAGIC, len(name), file.size, file.offset, total) + name
+
+
+# one frame header or file's data within the session stream
+class TCPySessionPart:
+    __slots__ = ('start', 'end', 'file', 'base', 'data', 'source')
+
+    def __init__(self, start, end, file=None, data=None):
+        self.start = start
+        self.end = end
+        self.file = file
+        # where the part's data starts within the file
+        self.base = (file.offset or 0) if file is not None else 0
+        self.data = data
+        self.source = None
+
+    # returns length bytes at offset within the part, opening the file on first use
+    def read(self, offset, length):
+        if self.data is None and self.source is None:
+            if self.file.size <= SMALL_FILE:
+                with open(self.file.path, "rb") as f:
+                    f.seek(self.base)
+                    self.data = memoryview(f.read(self.file.size))
+            else:
+                self.source = TCPyMmapSource(open(self.file.path, "rb"), self.base)
+        if self.data is not None:
+            chunk = self.data[offset:offset + length]
+        else:
+            chunk = self.source.read(self.base + offset, length)
+        if len(chunk) != length:
+            raise ValueError("{} changed size while being sent".format(self.file.path))
+        return chunk
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.file is not None:
+            self.data = None
+
+
+# the framed stream of a session, laid out up front from the file sizes - each file is only opened when
+# its data is first read and closed again once all of it has been ACK'ed
+class TCPySessionSource:
+
+    def __init__(self, files):
+        self.parts = []
+        offset = 0
+        for file in files:
+            header = frame_header(file)
+            self.parts.append(TCPySessionPart(offset, offset + len(header), data=memoryview(header)))
+            offset += len(header)
+            if file.size:
+                self.parts.append(TCPySessionPart(offset, offset + file.size, file=file))
+                offset += file.size
+        self.starts = [part.start for part in self.parts]
+        self.files = len(files)
+        self.size = offset
+        self.released = 0   # index of the first part not yet released
+
+    def __repr__(self):
+        return "session of {} files ({} bytes)".format(self.files, self.size)
+
+    # returns up to length bytes starting at offset, a view if they fall within a single part
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        i = bisect.bisect_right(self.starts, offset) - 1
+        pieces = []
+        while offset < end:
+            part = self.parts[i]
+            n = min(end, part.end) - offset
+            pieces.append(part.read(offset - part.start, n))
+            offset += n
+            i += 1
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
+
+    # the checksum sum16 of a payload lying within one mapped file, None otherwise
+    def payload_sum(self, offset, length):
+        part = self.parts[bisect.bisect_right(self.starts, offset) - 1]
+        if part.source is None or offset + length > part.end:
+            return None
+        return part.source.payload_sum(part.base + offset - part.start, length)
+
+    # closes every file whose data lies entirely below offset
+    def release(self, offset):
+        parts = self.parts
+        while self.released < len(parts) and parts[self.released].end <= offset:
+            parts[self.released].close()
+            self.released += 1
+        if self.released < len(parts) and parts[self.released].source is not None:
+            part = parts[self.released]
+            part.source.release(part.base + max(offset - part.start, 0))
+
+    # returns True if there is no data at or after offset
+    def at_end(self, offset):
+        return offset >= self.size
+
+    def close(self):
+        for part in self.parts[self.released:]:
+            part.close()
+
+
+class TCPySessionClient(TCPyClient):
+
+    def __init__(self, dest_address, source_port, dest_port, files, congestion='reno', mss=None, telemetry=None,
+                 pacing=None, fec=None):
+        self.files = list(files)
+        # files left for their own connections if the server turns down session framing
+        self.remaining_files = []
+        super().__init__(dest_address, source_port, dest_port, TCPySessionSource(self.files), congestion, mss,
+                         telemetry, pacing, fec)
+
+    def syn_options(self):
+        return TCPyClient.syn_options(self) + pkt.session_option()
+
+    # falls back to one file per connection if the server didn't answer the session option - file ranges can
+    # only be sent in a session
+    def negotiate(self, packet):
+        TCPyClient.negotiate(self, packet)
+        if not packet.SESSION:
+            if any(file.offset is not None for file in self.files):
+                self.abort("Server doesn't support sessions, file ranges can't be sent.")
+            print("Server doesn't support sessions, sending one file per connection.")
+            self.source.close()
+            self.FILENAME = self.files[0].path
+            self.source = open_source(self.FILENAME)
+            self.remaining_files = self.files[1:]
+
+    def send(self):
+        TCPyClient.send(self)
+        for file in self.remaining_files:
+            TCPyClient(self.DEST_ADDRESS, self.SOURCE_PORT, self.DEST_PORT, file.path, self.congestion,
+                       self.MSS_LIMIT, pacing=self.PACING, fec=self.FEC).send()
+
+
+# splits a session stream back into files as it arrives in order. open_file(name, offset, total) returns where a
+# file's data is written (None to only hash it) - offset and total are None for a whole file, or where a range goes
+# in the file and the size of the whole file. Every completed file or range is kept in files as
+# (name, size, sha256, offset, total)
+class TCPyFrameReader:
+
+    def __init__(self, open_file):
+        self.open_file = open_file
+        self.header = bytearray()
+        self.name = None
+        self.offset = None
+        self.total = None
+        self.size = 0
+        self.remaining = 0
+        self.digest = None
+        self.sink = None
+        self.files = []
+        self.error = None
+
+    # consumes the next bytes of the stream
+    def feed(self, data):
+        view = memoryview(data)
+        i = 0
+        while i < len(view) and self.error is None:
+            if self.name is None:
+                i = self.read_header(view, i)
+                continue
+            n = min(self.remaining, len(view) - i)
+            chunk = view[i:i + n]
+            self.digest.update(chunk)
+            if self.sink is not None:
+                self.sink.write(chunk)
+            self.remaining -= n
+            i += n
+            if not self.remaining:
+                self.finish_file()
+
+    # collects header bytes from view at i - the magic, then the rest of the header it calls for - starting
+    # the file once the whole header has arrived
+    def read_header(self, view, i):
+        header = self.header
+        frame = None
+        if len(header) < len(MAGIC):
+            need = len(MAGIC) - len(header)
+        else:
+            frame = FRAMES.get(bytes(header[:len(MAGIC)]))
+            need = frame.size - len(header)
+            if need <= 0:
+                need += frame.unpack_from(header)[1]
+        take = min(need, len(view) - i)
+        header += view[i:i + take]
+        i += take
+        if frame is None:
+            if len(header) == len(MAGIC) and bytes(header) not in FRAMES:
+                self.error = "bad frame at file {}".format(len(self.files) + 1)
+            return i
+        if len(header) < frame.size:
+            return i
+        fields = frame.unpack_from(header)
+        if len(header) < frame.size + fields[1]:
+            return i
+        self.name = bytes(header[frame.size:]).decode(errors='replace')
+        self.offset, self.total = fields[3:5] if frame is RANGE_FRAME else (None, None)
+        self.size = self.remaining = fields[2]
+        self.digest = hashlib.sha256()
+        self.sink = self.open_file(self.name, self.offset, self.total)
+        self.header = bytearray()
+        if not self.size:
+            self.finish_file()
+        return i
+
+    def finish_file(self):
+        if self.sink is not None:
+            self.sink.close()
+        self.files.append((self.name, self.size, self.digest.hexdigest(), self.offset, self.total))
+        self.name = None
+        self.sink = None
+
+    # True if the stream so far ends on a file boundary
+    @property
+    def complete(self):
+        return self.name is None and not self.header and self.error is None
@@ -0,0 +1,188 @@
+"""
+TCPySource.py
+
+This module supplies the file data the TCPy client sends. Rather than reading a whole file into
+memory up front, the client asks a source for the bytes of each segment by offset and tells the
+source when everything below an offset has been acknowledged, so resident memory stays bounded by
+the send window plus the unacknowledged segments instead of by the size of the file.
+
+    TCPyMmapSource    - regular files, mapped read-only and sliced without copying, with a
+                        TCPyChecksumIndex over the mapping when NumPy is available
+    TCPyResumedSource - the rest of a regular file from an offset, for a resumed transfer
+    TCPyChunkedSource - pipes, stdin, sockets or any iterable of bytes, buffered in chunks
+                        from the oldest unacknowledged byte up to the right edge of the window
+"""
+import collections
+import mmap
+import os
+import stat
+import sys
+
+from TCPyChecksum import checksum_index
+
+# size of each read from a pipe or stream
+CHUNK_SIZE = 64 * 1024
+# acknowledged mmap pages (and their checksum samples) are only dropped in batches of at least this many bytes
+RELEASE_BATCH = 4 * 1024 * 1024
+
+
+# read-only memory mapping of a regular file, of which only the part from start on may be sent
+class TCPyMmapSource:
+
+    def __init__(self, file, start=0):
+        self.file = file
+        self.size = os.fstat(file.fileno()).st_size
+        self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.released = start
+        if hasattr(self.mmap, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self.index = checksum_index(self.view, start)
+
+    # returns up to length bytes starting at offset as a view into the mapping
+    def read(self, offset, length):
+        return self.view[offset : offset + length]
+
+    # returns the checksum sum16 of the length bytes at offset as a packet payload, None without an index
+    def payload_sum(self, offset, length):
+        if self.index is None:
+            return None
+        return self.index.payload_sum(offset, length)
+
+    # tells the source nothing below offset will be read again
+    def release(self, offset):
+        if offset - self.released < RELEASE_BATCH:
+            return
+        if self.index is not None:
+            self.index.release(offset)
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            start = self.released - self.released % mmap.PAGESIZE
+            end = offset - offset % mmap.PAGESIZE
+            if end > start:
+                self.mmap.madvise(mmap.MADV_DONTNEED, start, end - start)
+        self.released = offset
+
+    # returns True if there is no data at or after offset
+    def at_end(self, offset):
+        return offset >= self.size
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # a view handed out by read() is still alive, the mapping is unmapped once that is dropped
+            pass
+        self.file.close()
+
+
+# the part of a regular file from start on, offsets counted from start - what is left of a resumed transfer
+class TCPyResumedSource(TCPyMmapSource):
+
+    def __init__(self, file, start):
+        super().__init__(file, start)
+        self.start = start
+
+    def read(self, offset, length):
+        return TCPyMmapSource.read(self, self.start + offset, length)
+
+    def payload_sum(self, offset, length):
+        return TCPyMmapSource.payload_sum(self, self.start + offset, length)
+
+    def release(self, offset):
+        TCPyMmapSource.release(self, self.start + offset)
+
+    def at_end(self, offset):
+        return TCPyMmapSource.at_end(self, self.start + offset)
+
+
+# buffered reader for data of unknown length, holding only the chunks that may still be (re)sent
+class TCPyChunkedSource:
+
+    def __init__(self, chunks, file=None):
+        self.chunks = iter(chunks)
+        self.file = file
+        self.size = None
+        self.buffer = collections.deque()
+        self.start = 0      # offset of the first buffered chunk
+        self.end = 0        # offset just past the last buffered chunk
+        self.exhausted = False
+
+    # pulls chunks from the underlying stream until offset is buffered or the stream ends
+    def fill(self, offset):
+        while self.end < offset and not self.exhausted:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.exhausted = True
+            elif chunk:
+                self.buffer.append(bytes(chunk))
+                self.end += len(chunk)
+
+    # returns up to length bytes starting at offset, a view if they fall within a single chunk. Only the first
+    # byte is waited for - a slow stream gives a short read rather than holding up the send loop for the rest
+    def read(self, offset, length):
+        self.fill(offset + 1)
+        if offset < self.start:
+            raise ValueError("offset {} was already released (buffer starts at {})".format(offset, self.start))
+        stop = min(offset + length, self.end)
+        pieces = []
+        chunk_start = self.start
+        for chunk in self.buffer:
+            chunk_end = chunk_start + len(chunk)
+            if chunk_end > offset:
+                pieces.append(memoryview(chunk)[max(offset - chunk_start, 0) : stop - chunk_start])
+                if chunk_end >= stop:
+                    break
+            chunk_start = chunk_end
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
+
+    # data read from a stream isn't indexed, packets carrying it are summed in full
+    def payload_sum(self, offset, length):
+        return None
+
+    # drops every buffered chunk that lies entirely below offset
+    def release(self, offset):
+        while self.buffer and self.start + len(self.buffer[0]) <= offset:
+            self.start += len(self.buffer.popleft())
+
+    # returns True if there is no data at or after offset
+    def at_end(self, offset):
+        self.fill(offset + 1)
+        return self.exhausted and offset >= self.end
+
+    def close(self):
+        self.buffer.clear()
+        if self.file is not None and self.file is not sys.stdin.buffer:
+            self.file.close()
+
+
+# yields reads of up to CHUNK_SIZE from a binary file object until EOF - read1() returns whatever a pipe has
+# ready instead of blocking until a whole chunk has arrived
+def read_chunks(file):
+    read = getattr(file, 'read1', file.read)
+    return iter(lambda: read(CHUNK_SIZE), b'')
+
+
+# opens the right kind of source for a filename ('-' for stdin), binary file object or iterable of bytes -
+# anything that already is a source (e.g. a TCPySessionSource) is used as it is
+def open_source(source):
+    if hasattr(source, 'at_end'):
+        return source
+    if isinstance(source, (str, bytes, os.PathLike)):
+        if source == '-':
+            return TCPyChunkedSource(read_chunks(sys.stdin.buffer), sys.stdin.buffer)
+        source = open(source, "rb")
+    if hasattr(source, 'read'):
+        try:
+            mode = os.fstat(source.fileno()).st_mode
+        except (AttributeError, OSError, ValueError):
+            mode = 0
+        # empty files can't be mapped, they go through the chunked reader and end immediately
+        if stat.S_ISREG(mode) and os.fstat(source.fileno()).st_size > 0:
+            return TCPyMmapSource(source)
+        return TCPyChunkedSource(read_chunks(source), source)
+    return TCPyChunkedSource(source)
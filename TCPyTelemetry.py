@@ -0,0 +1,266 @@
+"""
+TCPyTelemetry.py
+
+This module collects per-connection performance telemetry for the TCPy client, to tell whether a transfer
+was held back by loss, by the windows or by the CPU. A TCPyClient given a TCPyTelemetry keeps:
+
+    counters    - packets and bytes sent and ACK'ed, retransmissions by cause, window updates, and the
+                  time and calls spent encoding, decoding and in socket calls (time.encode, calls.encode, ...)
+    histograms  - RTT samples, retransmissions per packet, bytes in flight and congestion window per ACK
+                  batch, and ACKs per batch
+    events      - handed to hook callbacks registered with on(event, callback) ('*' for every event) and
+                  to trace writers, e.g. TCPyJsonTrace for JSON lines or TCPyPcapTrace for a capture
+                  Wireshark/tcpdump can open
+
+A client without telemetry pays one "is not None" test per packet or ACK batch - the codec and socket
+timing wrap the calls themselves, so the uninstrumented path is unchanged.
+"""
+import json
+import math
+import socket
+import struct
+import time
+
+from TCPyTimer import now
+
+# histogram buckets per power of two, i.e. bucket upper bounds are at most ~19% above the values in them
+SUB_BUCKETS = 4
+
+
+# log-scaled histogram of non-negative values - constant memory however many values are recorded
+class TCPyHistogram:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value > 0:
+            mantissa, exponent = math.frexp(value)
+            bucket = exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+        else:
+            bucket = None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    # upper bound of the bucket holding the p-th percentile, clipped to the largest value seen
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = self.buckets.get(None, 0)
+        if seen >= rank:
+            return 0
+        for bucket in sorted(b for b in self.buckets if b is not None):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                exponent, sub = divmod(bucket, SUB_BUCKETS)
+                return min(math.ldexp(0.5 + (sub + 1) / (2 * SUB_BUCKETS), exponent), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class TCPyTelemetry:
+
+    def __init__(self, traces=()):
+        self.counters = {}
+        self.histograms = {}
+        self.hooks = {}
+        self.traces = list(traces)
+        self.start_time = now()
+        self.end_time = None
+        # filled in by attach() for the trace writers
+        self.local = None
+        self.remote = None
+
+    # registers callback(event, fields) for an event name, or '*' for all of them
+    def on(self, event, callback):
+        self.hooks.setdefault(event, []).append(callback)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = TCPyHistogram()
+        histogram.record(value)
+
+    # reports an event to its hooks and the trace writers
+    def event(self, name, **fields):
+        if not self.traces and not self.hooks:
+            return
+        for callback in self.hooks.get(name, ()):
+            callback(name, fields)
+        for callback in self.hooks.get('*', ()):
+            callback(name, fields)
+        elapsed = now() - self.start_time
+        for trace in self.traces:
+            trace.event(elapsed, name, fields)
+
+    # hands a packet as sent or received to the trace writers
+    def packet(self, outgoing, data):
+        if not self.traces:
+            return
+        current_time = time.time()
+        for trace in self.traces:
+            trace.packet(current_time, outgoing, data, self.local, self.remote)
+
+    # wraps func so its calls and the time spent in them are counted as calls.<name> and time.<name>
+    def timed(self, name, func):
+        counters = self.counters
+        time_key = 'time.' + name
+        calls_key = 'calls.' + name
+        counters.setdefault(time_key, 0.0)
+        counters.setdefault(calls_key, 0)
+        perf_counter = time.perf_counter
+
+        def timed_call(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counters[time_key] += perf_counter() - start
+                counters[calls_key] += 1
+        return timed_call
+
+    # takes the connection's addresses from the client and starts the clock
+    def attach(self, client):
+        self.local = (client.SOURCE_ADDRESS, client.SOURCE_PORT)
+        self.remote = (socket.gethostbyname(client.DEST_ADDRESS), client.DEST_PORT)
+        self.start_time = now()
+        self.event('connection', local=list(self.local), remote=list(self.remote), file=str(client.FILENAME))
+
+    # counters, histogram summaries and goodput (ACK'ed bytes per second) so far
+    def summary(self):
+        elapsed = (self.end_time or now()) - self.start_time
+        return {
+            'elapsed': elapsed,
+            'goodput': self.counters.get('bytes_acked', 0) / elapsed if elapsed > 0 else None,
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+        }
+
+    # stops the clock, writes the summary as the last event and closes the trace writers
+    def close(self):
+        if self.end_time is None:
+            self.end_time = now()
+            self.event('summary', **self.summary())
+        for trace in self.traces:
+            trace.close()
+        self.traces = []
+
+
+# times the socket calls and hands every datagram to the telemetry, standing in for the client's socket
+class TCPyInstrumentedSocket:
+
+    def __init__(self, sock, telemetry):
+        self.sock = sock
+        self.telemetry = telemetry
+        self.timed_sendall = telemetry.timed('send', sock.sendall)
+        self.timed_sendmsg = telemetry.timed('send', sock.sendmsg) if hasattr(sock, 'sendmsg') else None
+        self.timed_recvfrom_into = telemetry.timed('recv', sock.recvfrom_into) if hasattr(sock, 'recvfrom_into') else None
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        self.timed_sendall(data)
+        self.telemetry.packet(True, data)
+
+    # a socket without sendmsg() gets the buffers joined
+    def sendmsg(self, buffers):
+        if self.timed_sendmsg is None:
+            self.sendall(b''.join(buffers))
+            return
+        self.timed_sendmsg(buffers)
+        if self.telemetry.traces:
+            self.telemetry.packet(True, b''.join(buffers))
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        received, address = self.timed_recvfrom_into(buffer, nbytes, flags)
+        if self.telemetry.traces:
+            self.telemetry.packet(False, bytes(buffer[:received]))
+        return received, address
+
+
+# writes events as JSON lines - {"t": seconds since the connection started, "event": name, ...fields}
+class TCPyJsonTrace:
+
+    def __init__(self, file):
+        self.file = open(file, "w") if isinstance(file, str) else file
+
+    def event(self, elapsed, name, fields):
+        record = {'t': round(elapsed, 6), 'event': name}
+        record.update(fields)
+        self.file.write(json.dumps(record) + "\n")
+
+    def packet(self, current_time, outgoing, data, local, remote):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+# writes packets as a pcap capture. TCPy segments are laid out like TCP, so each one is written behind an
+# IPv4 header with protocol TCP (raw IP link type) and tools decode the ports, flags and options directly -
+# the UDP encapsulation isn't shown, and the TCPy checksum won't match what TCP would expect
+class TCPyPcapTrace:
+    FILE_HEADER = struct.Struct('<IHHiIII')
+    RECORD_HEADER = struct.Struct('<IIII')
+    IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+    LINKTYPE_RAW = 101
+    SNAPLEN = 65535
+
+    def __init__(self, file):
+        self.file = open(file, "wb") if isinstance(file, str) else file
+        self.file.write(self.FILE_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, self.SNAPLEN, self.LINKTYPE_RAW))
+        self.ident = 0
+
+    def event(self, elapsed, name, fields):
+        pass
+
+    def packet(self, current_time, outgoing, data, local, remote):
+        source, dest = (local, remote) if outgoing else (remote, local)
+        self.ident = (self.ident + 1) & 0xFFFF
+        header = bytearray(self.IP_HEADER.pack(0x45, 0, 20 + len(data), self.ident, 0x4000, 64, socket.IPPROTO_TCP,
+                                               0, socket.inet_aton(source[0]), socket.inet_aton(dest[0])))
+        # the IPv4 header checksum is the one's complement of the one's complement sum of its words
+        total = sum(struct.unpack('!10H', header))
+        total = (total & 0xFFFF) + (total >> 16)
+        total = (total & 0xFFFF) + (total >> 16)
+        struct.pack_into('!H', header, 10, ~total & 0xFFFF)
+        length = min(len(header) + len(data), self.SNAPLEN)
+        seconds = int(current_time)
+        self.file.write(self.RECORD_HEADER.pack(seconds, int((current_time - seconds) * 1e6), length,
+                                                len(header) + len(data)))
+        self.file.write((bytes(header) + bytes(data))[:length])
+
+    def close(self):
+        self.file.close()
+
+
+# returns the trace writer for a path - pcap for .pcap/.cap files, JSON lines otherwise
+def open_trace(path):
+    if path.endswith(('.pcap', '.cap')):
+        return TCPyPcapTrace(path)
+    return TCPyJsonTrace(path)
@@ -0,0 +1,125 @@
+"""
+TCPyTimer.py
+
+This module handles retransmission timing for the TCPy client. TCPyRTO estimates the retransmission
+timeout from measured round trip times as specified by RFC 6298:
+
+    first sample R:     SRTT <- R,  RTTVAR <- R/2
+    later samples R':   RTTVAR <- (1 - beta) * RTTVAR + beta * |SRTT - R'|
+                        SRTT   <- (1 - alpha) * SRTT + alpha * R'
+    always:             RTO    <- SRTT + max(G, K * RTTVAR), clamped to [MIN_RTO, MAX_RTO]
+
+with samples taken only from segments that were never retransmitted (Karn's rule) - unless the peer
+echoes RFC 7323 timestamps, which say which copy was ACK'ed - and the RTO doubled on every expiry until
+a new sample arrives. TCPyRetransmitQueue keeps the per-segment deadlines in a
+heap so finding the next expiry costs O(log n) rather than a scan over every unACK'ed segment.
+"""
+import heapq
+import time
+
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+# clock granularity of time.monotonic() is far below a millisecond, use 1 ms as G
+CLOCK_GRANULARITY = 0.001
+INITIAL_RTO = 1.0
+# RFC 6298 suggests a 1 s floor, but like most stacks we allow a lower one - 200 ms matches Linux
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+
+# clock used for all send times and deadlines
+now = time.monotonic
+
+# RFC 7323 timestamp clock, in ticks per second
+TS_HZ = 1000
+
+
+# current timestamp clock value as sent in TSval
+def ts_now():
+    return int(now() * TS_HZ) & 0xFFFFFFFF
+
+
+# seconds since the timestamp clock read tsval, e.g. an echoed TSecr
+def ts_elapsed(tsval):
+    return ((ts_now() - tsval) & 0xFFFFFFFF) / TS_HZ
+
+
+class TCPyRTO:
+
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.backoffs = 0
+
+    # feeds a round trip time measured on a segment that was never retransmitted, or timed by an echoed timestamp
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(max(self.srtt + max(CLOCK_GRANULARITY, K * self.rttvar), self.min_rto), self.max_rto)
+        self.backoffs = 0
+
+    # doubles the RTO after a retransmission timeout
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_rto)
+        self.backoffs += 1
+
+
+# deadline heap keyed by segment - cancelled and rescheduled entries are dropped lazily as they surface
+class TCPyRetransmitQueue:
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    # sets (or moves) the deadline of key
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        # keep stale entries from piling up when most segments are ACK'ed well before they expire
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, k) for (k, d) in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    # stops the timer for key, e.g. once it is ACK'ed
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    # drops heap entries that no longer match a live deadline
+    def discard_stale(self):
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    # returns the earliest deadline or None if nothing is scheduled
+    def next_deadline(self):
+        self.discard_stale()
+        return self.heap[0][0] if self.heap else None
+
+    # returns seconds until the earliest deadline (0 if already past) or None if nothing is scheduled
+    def time_left(self, current_time=None):
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - (current_time if current_time is not None else now()), 0)
+
+    # removes and returns the keys of every deadline at or before current_time, earliest first
+    def pop_expired(self, current_time):
+        expired = []
+        heap = self.heap
+        self.discard_stale()
+        while heap and heap[0][0] <= current_time:
+            deadline, key = heapq.heappop(heap)
+            del self.deadlines[key]
+            expired.append(key)
+            self.discard_stale()
+        return expired
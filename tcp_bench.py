@@ -0,0 +1,203 @@
+# tcp_bench.py
+"""
+Benchmarks for the TCPy client. Transfer benchmarks run tcp_client.py against the reference receiver in
+tcp_server.py over loopback for every combination of file size and impairment profile, and codec
+benchmarks time the per-packet TCPyPacket operations. Every result is one JSON object per line so runs
+can be stored and compared between versions:
+
+    {"bench": "transfer", "profile": "lossy", "size": 1048576, "goodput": ..., "retrans_ratio": ..., ...}
+    {"bench": "codec", "op": "package_packet", "payload": 1452, "ns_per_op": ...}
+
+goodput is file bytes per second between the SYN and the last byte being delivered, retrans_ratio is
+data segments put on the wire per segment of the file minus one, and completion_time is measured at the
+receiver so interpreter start-up isn't counted.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import socket as s
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from TCPyChecksum import checksum_index
+from TCPyPacket import TCPyPacket as pkt
+from tcp_server import TCPyImpairment, TCPyServer
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tcp_client.py")
+
+PROFILES = {
+    'clean':     {},
+    'lossy':     {'loss': 0.02},
+    'reorder':   {'reorder': 0.05, 'delay': 0.002, 'jitter': 0.001},
+    'duplicate': {'duplicate': 0.05},
+    'wan':       {'delay': 0.02, 'jitter': 0.002, 'loss': 0.005, 'bandwidth': 12.5e6, 'queue': 256 * 1024},
+    # a bottleneck with a shallow buffer, where bursts of a whole window overflow the queue
+    'shallow':   {'delay': 0.01, 'bandwidth': 12.5e6, 'queue': 128 * 1024},
+}
+DEFAULT_SIZES = "64K,1M,8M"
+UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+
+
+# parses sizes like 64K or 8M
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+# returns a port on the loopback interface that is currently free
+def free_port():
+    sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# the commit being measured, so results from different versions can be told apart
+def version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(CLIENT),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# creates (or reuses) a random file of the given size, returning its path and sha256
+def make_file(directory, size):
+    path = os.path.join(directory, "bench_{}.bin".format(size))
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(remaining, 1 << 20))
+            digest.update(block)
+            f.write(block)
+            remaining -= len(block)
+    return path, digest.hexdigest()
+
+
+# runs one client transfer against a fresh receiver and returns its result record
+def run_transfer(path, size, digest, profile, client_args, timeout, seed):
+    settings = PROFILES[profile]
+    server = TCPyServer('127.0.0.1', 0, impairment=TCPyImpairment(seed=seed, **settings),
+                        return_impairment=TCPyImpairment(seed=seed + 1, **settings)).start()
+    client_port = free_port()
+    command = [sys.executable, CLIENT, "-a", "127.0.0.1", "-f", path,
+               "-cp", str(client_port), "-sp", str(server.PORT)] + client_args
+    start = time.monotonic()
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        returncode = result.returncode
+        error = result.stderr.decode(errors='replace').strip().splitlines()[-1:] or None
+    except subprocess.TimeoutExpired:
+        returncode = None
+        error = ["timed out after {} s".format(timeout)]
+    wall_time = time.monotonic() - start
+    server.stop()
+
+    conns = [c for c in server.finished if c.CLIENT_PORT == client_port]
+    conns += [c for c in server.connections.values() if c.CLIENT_PORT == client_port and c not in conns]
+    record = {
+        'bench': 'transfer', 'profile': profile, 'size': size, 'client_args': client_args,
+        'returncode': returncode, 'wall_time': wall_time, 'ok': False,
+    }
+    if conns:
+        stats = conns[0].stats()
+        needed = max(stats['segments'] - stats['duplicates'], 1)
+        record.update({
+            'ok': returncode == 0 and stats['complete'] and stats['sha256'] == digest,
+            'completion_time': stats['completion_time'],
+            'goodput': stats['bytes'] / stats['completion_time'] if stats['completion_time'] else None,
+            'retrans_ratio': stats['transmissions'] / needed - 1,
+            'transmissions': stats['transmissions'],
+            'segments': needed,
+        })
+    if not record['ok'] and error:
+        record['error'] = error[0]
+    return record
+
+
+# times the per-packet codec operations, in nanoseconds per call
+def run_codec(payload, number):
+    data = os.urandom(payload)
+    kwargs = dict(source_address='127.0.0.1', dest_address='127.0.0.1', source_port=5000, dest_port=5001,
+                  seq_num=123456789, ack_num=987654321, ack=True, window=65535, data=data)
+    packet = bytes(pkt.package_packet(**kwargs))
+    ops = {
+        'package_packet': lambda: pkt.package_packet(**kwargs),
+        'unpack_packet': lambda: pkt.unpack_packet('127.0.0.1', '127.0.0.1', packet),
+        'valid_checksum': lambda: pkt.valid_checksum('127.0.0.1', '127.0.0.1', packet),
+    }
+    index = checksum_index(data)
+    if index is not None:
+        # building from a file with a checksum index, payload summed by the index
+        ops['package_packet_indexed'] = lambda: pkt.package_packet(
+            payload_sum=index.payload_sum(0, payload), **kwargs)
+    records = []
+    for op, func in ops.items():
+        elapsed = min(timeit.repeat(func, number=number, repeat=3))
+        records.append({'bench': 'codec', 'op': op, 'payload': payload, 'ns_per_op': elapsed / number * 1e9})
+    return records
+
+
+class Main:
+
+    # Parsing for argument flags
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sizes", default=DEFAULT_SIZES, type=str, help="comma separated file sizes, e.g. 64K,1M")
+    parser.add_argument("-profiles", default=",".join(PROFILES), type=str,
+                        help="comma separated impairment profiles ({})".format(", ".join(PROFILES)))
+    parser.add_argument("-cc", default=None, type=str, help="congestion control passed to the client")
+    parser.add_argument("-pace", default=None, type=str, help="pacing rate passed to the client")
+    parser.add_argument("-fec", default=None, type=str, help="FEC block size passed to the client")
+    parser.add_argument("-repeat", default=1, type=int, help="runs per size and profile")
+    parser.add_argument("-timeout", default=300, type=float, help="seconds before a transfer is abandoned")
+    parser.add_argument("-codec", default=20000, type=int, help="codec iterations per op, 0 to skip")
+    parser.add_argument("-no-transfers", dest="transfers", action="store_false", help="skip the end to end transfers")
+    parser.add_argument("-o", default=None, type=str, help="also append results to this file")
+
+    def __init__(self, argv=None):
+        args = self.parser.parse_args(argv)
+        profiles = [p.strip() for p in args.profiles.split(",") if p.strip()]
+        for profile in profiles:
+            if profile not in PROFILES:
+                self.parser.exit(message="\tERROR(args): Unknown profile {}\n".format(profile))
+        client_args = ["-cc", args.cc] if args.cc else []
+        if args.pace:
+            client_args += ["-pace", args.pace]
+        if args.fec:
+            client_args += ["-fec", args.fec]
+        self.out = open(args.o, "a") if args.o else None
+        self.meta = {'version': version(), 'python': platform.python_version(), 'time': time.time()}
+
+        if args.codec:
+            for payload in (0, 1452):
+                for record in run_codec(payload, args.codec):
+                    self.emit(record)
+        if args.transfers:
+            with tempfile.TemporaryDirectory(prefix="tcpy_bench_") as directory:
+                for size in map(parse_size, args.sizes.split(",")):
+                    path, digest = make_file(directory, size)
+                    for profile in profiles:
+                        for run in range(args.repeat):
+                            self.emit(run_transfer(path, size, digest, profile, client_args, args.timeout, seed=run))
+        if self.out is not None:
+            self.out.close()
+
+    def emit(self, record):
+        record.update(self.meta)
+        line = json.dumps(record, sort_keys=True)
+        print(line, flush=True)
+        if self.out is not None:
+            self.out.write(line + "\n")
+
+
+if __name__ == "__main__":
+    Main()
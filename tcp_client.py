@@ -2,18 +2,52 @@
 # Author: Kristopher Carroll
 
 from TCPyPacket import TCPyPacket as pkt
+from TCPyPacket import FEC_PARITY_LEN, HEADER_LEN, IP_UDP_OVERHEAD, MAX_MSS, TIMESTAMP_LEN
+from TCPyCongestion import CONGESTION_CONTROLS, create_congestion_control
+from TCPyFec import MAX_BLOCK, REBUILD_WAIT, TCPyFecEncoder
+from TCPyJournal import JOURNAL_SUFFIX, RESUME_UNIT, TCPyJournal, journal_path
+from TCPyPacer import TCPyPacer, parse_rate
+from TCPyScoreboard import TCPyScoreboard
+from TCPySource import TCPyResumedSource, open_source
+from TCPyTimer import TCPyRTO, TCPyRetransmitQueue, now, ts_elapsed, ts_now
 import socket as s
+import select
 import time
 import argparse
+import os
 
+# segment size assumed when the server's SYN/ACK doesn't carry an MSS option
 MAX_BYTES = 1452
+MAX_SYN_RETRIES = 5
+# times one packet is retransmitted before the server is given up on - like Linux's tcp_retries2, about
+# 15 minutes with the RTO backed off to MAX_RTO
+MAX_RETRIES = 15
+DUP_ACK_THRESHOLD = 3
+# most datagrams drained from the socket per wakeup, and the buffer size for each
+RECV_BATCH = 64
+RECV_SLOT = 2048
+# non-blocking receive flag where the platform has one, otherwise queued datagrams are found with select()
+MSG_DONTWAIT = getattr(s, 'MSG_DONTWAIT', 0)
+# Linux getsockopt() for the path MTU of a connected socket - Python doesn't export the constant
+IP_MTU = getattr(s, 'IP_MTU', 14)
 """
 This modular implementation of a TCP client features a robust packet engine for packing and unpacking
 TCP segments, determining their validity, and handles the main driver logic for sending files via
 TCP. This implementation uses Selective Repeat to provide reliable data transfer while maximizing the 
 available window space by allowing for unordered, non-cumulative ACKs. The implementation
-selectively retransmits packets that have been unACK'ed and have timed out (>500 ms) on a per-packet
-basis. Connections are established with a time-based Initial Sequence Number during the SYN phase of the handshake.
+selectively retransmits packets that have been unACK'ed and have timed out on a per-packet basis, using a
+retransmission timeout adapted to the measured round trip time (RFC 6298). Connections are established with a time-based Initial Sequence Number during the SYN phase of the handshake.
+The SYN offers SACK (RFC 2018) - if the server accepts, ACKs are cumulative with SACK blocks, otherwise
+each per-packet ACK is recorded as a SACK of that packet. Either way in-flight packets are tracked on a
+scoreboard, and a hole with DUP_ACK_THRESHOLD packets SACK'ed above it is fast retransmitted.
+The SYN also offers an MSS taken from the path MTU, window scaling and timestamps (RFC 7323) - packet size
+follows the smaller of the two MSS values, the server's window is scaled past 64 KiB, and echoed timestamps
+give RTT samples even for retransmitted packets.
+New packets can optionally be paced, at a fixed rate or at cwnd / SRTT, rather than sent a window at a time.
+FEC can be offered too - if the server takes it, every block of packets is followed by a parity packet the
+server can rebuild one lost packet of the block from, saving its retransmission.
+With a journal (see TCPyJournal) the ACK'ed offset is checkpointed as the file is sent, and a transfer that
+was cut short starts again from what the server already has instead of from the first byte.
 """
 
 class TCPyClient:
@@ -73,19 +107,35 @@ class TCPyClient:
 
     
 
-    def __init__(self, dest_address, source_port, dest_port, filename):
+    def __init__(self, dest_address, source_port, dest_port, filename, congestion='reno', mss=None, telemetry=None,
+                 pacing=None, fec=None, resume=None):
         self.FILENAME = filename
-        self.file = open(filename, "rb")
-        # create socket and apply the appropriate connection information
-        self.sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
+        # stream the file rather than reading it all in - '-' sends stdin
+        self.source = open_source(filename)
+        # apply the appropriate connection information and create the socket
         self.SOURCE_ADDRESS = s.gethostbyname(s.gethostname())
         self.DEST_ADDRESS = dest_address
         self.SOURCE_PORT = source_port
         self.DEST_PORT = dest_port
         self.SERVER = (self.DEST_ADDRESS, self.DEST_PORT)
-        self.sock.bind(('', self.SOURCE_PORT))
-        # set the time-based initial sequence number
-        self.SEQ_VARS['ISS'] = int(time.time()) % 2**32
+        self.sock = self.open_socket()
+        # optional TCPyTelemetry - when given, the socket and packet codec are swapped for timed versions
+        self.telemetry = telemetry
+        self.package_packet = pkt.package_packet
+        self.unpack_packet = pkt.unpack_packet
+        if telemetry is not None:
+            from TCPyTelemetry import TCPyInstrumentedSocket
+            self.sock = TCPyInstrumentedSocket(self.sock, telemetry)
+            self.package_packet = telemetry.timed('encode', pkt.package_packet)
+            self.unpack_packet = telemetry.timed('decode', pkt.unpack_packet)
+            telemetry.attach(self)
+        # scatter-gather send of a header and payload as one datagram, where the socket has it
+        self.sendmsg = getattr(self.sock, 'sendmsg', None)
+        # each connection gets its own copy of the sequence variables
+        self.SEQ_VARS = dict(TCPyClient.SEQ_VARS)
+        # set the time-based initial sequence number - the RFC 793 clock ticks every 4 microseconds, so
+        # connections opened back to back from the same port still get different ones
+        self.SEQ_VARS['ISS'] = int(time.time() * 250000) % 2**32
 
         # set up TCP states and handlers dictionary
         self.TCP_STATES = {
@@ -95,7 +145,57 @@ class TCPyClient:
             'FIN-WAIT-1': self.handle_fin_wait_1,
         }
 
-        self.unack_packets = {}
+        # in-flight packets in sequence order, and whether the server sends cumulative ACKs with SACK blocks
+        self.scoreboard = TCPyScoreboard(DUP_ACK_THRESHOLD)
+        self.sack_ok = False
+        # negotiated options - the MSS offered (capped by mss if given), the payload per packet, the shift applied
+        # to the server's windows, and the last timestamp received from the server when timestamps are on
+        self.MSS_LIMIT = mss
+        self.local_mss = MAX_BYTES
+        self.seg_size = MAX_BYTES
+        self.snd_wscale = 0
+        self.ts_ok = False
+        self.ts_recent = 0
+        # congestion window, consulted alongside RCV.WND before sending new data - recreated with the negotiated
+        # segment size once the handshake is done
+        self.congestion = congestion
+        self.cc = create_congestion_control(congestion, MAX_BYTES)
+        # optional pacing of new packets - 'auto' follows cwnd / SRTT, a number is a fixed rate in bytes per second.
+        # pace_wait is how long the pacer is holding back the next packet, None when it isn't
+        self.PACING = pacing
+        self.pacer = None if pacing is None else TCPyPacer(None if pacing == 'auto' else pacing)
+        self.pace_wait = None
+        # optional FEC - 'auto' adapts the block size to the loss rate, a number fixes it. The encoder is only
+        # created once the server has accepted FEC
+        self.FEC = fec
+        self.fec = None
+        # optional journal of the ACK'ed offset, so a transfer cut short can be resumed - resume is its path.
+        # resume_offset is where in the file the data sent on this connection starts
+        self.RESUME = resume
+        self.journal = None if resume is None else TCPyJournal(resume, filename)
+        self.resume_offset = 0
+        # retransmission timers and RFC 6298 RTO estimate
+        self.retrans_queue = TCPyRetransmitQueue()
+        self.rto = TCPyRTO()
+        self.syn_time = None
+        self.syn_retries = 0
+        # receive buffers, allocated on first use
+        self.recv_views = None
+
+    # creates the UDP socket bound to the client port
+    def open_socket(self):
+        sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
+        sock.bind(('', self.SOURCE_PORT))
+        return sock
+
+    # reports a fatal error for the current state and shuts the client down
+    def abort(self, message):
+        print("ERROR({}): {}".format(self.CURR_STATE, message))
+        print("Shutting down client.")
+        self.sock.close()
+        if self.journal is not None:
+            self.journal.close()
+        exit(1)
 
     #                               CONNECTION STATE HANDLERS
     ############################################################################################
@@ -103,6 +203,7 @@ class TCPyClient:
     def handle_closed(self):
         print("Attempting to connect to {}:{}".format(self.DEST_ADDRESS, self.DEST_PORT))
         self.sock.connect(self.SERVER)
+        self.local_mss = self.probe_mss()
         if self.send_syn():
             self.SEQ_VARS['SND.UNA'] = self.SEQ_VARS['ISS'] # setting earliest sent unack to ISS
             self.SEQ_VARS['SND.NXT'] = self.SEQ_VARS['ISS'] + 1 # setting next seq num to send
@@ -110,159 +211,460 @@ class TCPyClient:
             return
         # wasn't able to successfully send SYN
         else:
-            print("ERROR({}): Unable to send SYN packet.".format(self.CURR_STATE))
-            print("Shutting down client.")
-            self.sock.close()
-            exit(1)
+            self.abort("Unable to send SYN packet.")
 
     # function for handling SYN-SENT state operations and events
     def handle_syn_sent(self):
         try:
-            bytes_packet, address = self.sock.recvfrom(4096)
-            packet = pkt.unpack_packet(self.SOURCE_ADDRESS, self.DEST_ADDRESS, bytes_packet)
-            if packet['ACK'] and packet['SYN']:
-                if packet['ACK_NUM'] != self.SEQ_VARS['SND.NXT']:
-                    print("ERROR({}): Wrong ACK for handshake.".format(self.CURR_STATE))
-                    print("Shutting down client.")
-                    self.sock.close()
-                    exit(1)
-                self.SEQ_VARS['SND.NXT'] = packet['ACK_NUM'] # ACK of 101 means expecting SEQ 101
-                self.SEQ_VARS['RCV.WND'] = packet['WINDOW']
-                self.send_ack(packet['SEQ_NUM'] + 1)
-                self.unack_packets[packet['ACK_NUM']] = (packet['ACK_NUM'], None, time.time())
-                self.SEQ_VARS['SND.UNA'] = packet['ACK_NUM']
-                self.CURR_STATE = 'ESTABLISHED'
-                return
+            # wait for the SYN/ACK until the SYN's retransmission timer runs out
+            for packet in self.receive_packets(self.syn_time_left()):
+                if self.CURR_STATE == 'SYN-SENT':
+                    self.process_synack(packet)
         except s.timeout:
-            print("ERROR({}): Timed out while waiting for ack to SYN.")
-            print("Shutting down client.")
-            self.sock.close()
-            exit(1)
+            self.retransmit_syn()
 
     # where the beef of the sending occurs
     def handle_established(self):
         # repeatedly send new packets to fill remaining window and retransmit timed out packets
-        bytes_data = self.file.read()
-        bytes_size = len(bytes_data)
-        done = False
-        while not done:
-            # retransmit timed out packets
-            retrans_pack = {k:v for (k, v) in self.unack_packets.items() if time.time() - v[2] > 0.5}
-            for k, v in retrans_pack.items():
-                try:
-                    self.sock.sendall(v[0].bytes)
-                    self.unack_packets[k] = (v[0],v[1], time.time())
-                except s.timeout:
-                    print("ERROR({}): Error retransmitting expired packet (seq = {}).".format(self.CURR_STATE, k))
-                    print("Shutting down client.")
-                    self.sock.close()
-                    exit(1)
-
-            # grab the next bytes available to send - may be nothing if we didn't get an increase in window size
-            start_index = self.SEQ_VARS['SND.NXT'] - self.SEQ_VARS['ISS'] - 1
-            end_index = (self.SEQ_VARS['SND.UNA'] + self.SEQ_VARS['RCV.WND']) - self.SEQ_VARS['ISS'] - 1
-            if end_index >= bytes_size - 1:
-                done = True
-            new_size = end_index - start_index
-            new_data = bytes_data[start_index : end_index]
-
-            data_chunks = [new_data[i * MAX_BYTES : (i+1) * MAX_BYTES] for i in range((len(new_data) // MAX_BYTES) + 1)]
-            for chunk in data_chunks:
-                if len(chunk) == 0:
-                    break
-                new_packet = pkt.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
-                                    source_port=self.SOURCE_PORT, dest_port=self.DEST_PORT, 
-                                    seq_num=self.SEQ_VARS['SND.NXT'], data=chunk)
-                # send the packets and handle errors
-                try:
-                    start_time = time.time()
-                    self.sock.sendall(new_packet.bytes)
-                    # update SND.NXT and add packet to list of unack'ed packets with timer
-                    self.SEQ_VARS['SND.NXT'] += len(chunk)
-                    self.unack_packets[self.SEQ_VARS['SND.NXT']] = (self.SEQ_VARS['SND.NXT'],new_packet, start_time)
-                    
-                except s.timeout:
-                    print("ERROR({}): Error sending packet (seq = {}).".format(self.CURR_STATE, self.SEQ_VARS['SND.NXT']))
-                    print("Shutting down client.")
-                    self.sock.close()
-                    exit(1)
-            if done:
-                if not self.send_fin():
-                    print("ERROR({}): Error sending FIN.")
-                    print("Shutting down client.")
-                    self.sock.close()
-                    exit(1)
-                self.CURR_STATE = 'FIN-WAIT-1'
+        while True:
+            self.retransmit_expired()
+            self.send_new_data()
+            if self.finish_sending():
                 return
-            
-            # wait for ACKs - we've sent everything we can and there's nothing to do until then
-            bytes_packet, address = self.sock.recvfrom(4096)
-            rec_packet = pkt.unpack_packet(self.SOURCE_ADDRESS, self.DEST_ADDRESS, bytes_packet)
-            if not rec_packet or not rec_packet.get('ACK'):
-                print("ERROR({}): Packet received was not an ACK.")
+
+            # wait for ACKs - we've sent everything we can, so sleep until one arrives or the next timer expires
+            try:
+                rec_packets = self.receive_packets(self.ack_wait_time())
+            except s.timeout:
                 continue
-            self.unack_packets.pop(rec_packet['ACK_NUM'])
-            if self.unack_packets:
-                self.SEQ_VARS['SND.UNA'] = min(self.unack_packets, key=self.unack_packets.get) # update SND.UNA to oldest unack left
-            self.SEQ_VARS['RCV.NXT'] = rec_packet['ACK_NUM'] # RCV.NXT updated to next expected seg
-            self.SEQ_VARS['RCV.WND'] = rec_packet['WINDOW']
-        return
+            self.process_acks(rec_packets)
 
     # handler for FIN-WAIT-1 state - the state which handles all unack'ed packets and waits for FIN or ACK of FIN back
     def handle_fin_wait_1(self):
-        while self.unack_packets:
-            # retransmit timed out packets
-            retrans_pack = {k:v for (k, v) in self.unack_packets.items() if time.time() - v[2] > 0.5}
-            for k, v in retrans_pack.items():
-                try:
-                    self.sock.sendall(v[1].bytes)
-                    self.unack_packets[k] = (v[0], v[1], time.time())
-                except s.timeout:
-                    print("ERROR({}): Error retransmitting expired packet (seq = {}).".format(self.CURR_STATE, k))
-                    print("Shutting down client.")
-                    self.sock.close()
-                    exit(1)
+        while self.scoreboard:
+            self.retransmit_expired()
             # wait for ACKs
-            bytes_packet, address = self.sock.recvfrom(4096)
-            rec_packet = pkt.unpack_packet(self.SOURCE_ADDRESS, self.DEST_ADDRESS, bytes_packet)
-            if not rec_packet or not rec_packet.get('ACK'):
-                print("ERROR({}): Packet received was not an ACK.")
+            try:
+                rec_packets = self.receive_packets(self.timer_wait_time())
+            except s.timeout:
                 continue
-            self.unack_packets.pop(rec_packet['ACK_NUM'])
+            self.process_acks(rec_packets)
         # all packets ACK
         self.CURR_STATE = 'DONE'
         return
 
+    #                               HANDSHAKE, SENDING AND ACK PROCESSING
+    ############################################################################################
+    # the MSS to offer - the path MTU the kernel knows for the server, less the IP, UDP and TCPy headers
+    def probe_mss(self):
+        try:
+            mtu = self.sock.getsockopt(s.IPPROTO_IP, IP_MTU)
+            mss = min(mtu - IP_UDP_OVERHEAD - HEADER_LEN, MAX_MSS)
+        except OSError:
+            mss = MAX_BYTES
+        if self.MSS_LIMIT:
+            mss = min(mss, self.MSS_LIMIT)
+        return max(mss, TIMESTAMP_LEN + 1)
+
+    # seconds left before the SYN should be resent
+    def syn_time_left(self):
+        return max(self.syn_time + self.rto.rto - now(), 0)
+
+    # completes the handshake if packet is the SYN/ACK, moving to ESTABLISHED
+    def process_synack(self, packet):
+        if packet and packet.ACK and packet.SYN:
+            if packet.ACK_NUM != self.SEQ_VARS['SND.NXT']:
+                self.abort("Wrong ACK for handshake.")
+            # the handshake gives the first RTT sample unless the SYN had to be resent
+            if self.syn_retries == 0:
+                self.sample_rtt(now() - self.syn_time)
+            self.SEQ_VARS['SND.NXT'] = packet.ACK_NUM # ACK of 101 means expecting SEQ 101
+            self.SEQ_VARS['RCV.WND'] = packet.WINDOW # never scaled in a SYN
+            self.negotiate(packet)
+            self.send_ack(packet.SEQ_NUM + 1)
+            self.SEQ_VARS['SND.UNA'] = packet.ACK_NUM
+            self.CURR_STATE = 'ESTABLISHED'
+
+    # applies the options the server answered the SYN with - anything it left out stays off
+    def negotiate(self, packet):
+        self.sack_ok = packet.SACK_PERM
+        if packet.WSCALE is not None:
+            self.snd_wscale = packet.WSCALE
+        if packet.TS is not None:
+            self.ts_ok = True
+            self.ts_recent = packet.TS[0]
+        # the MSS counts payload plus options, so room for the timestamps every packet carries comes out of it
+        mss = min(packet.MSS or MAX_BYTES, self.local_mss)
+        self.seg_size = mss - TIMESTAMP_LEN if self.ts_ok else mss
+        if self.FEC is not None and packet.FEC:
+            self.fec = TCPyFecEncoder(None if self.FEC == 'auto' else min(self.FEC, packet.FEC))
+            # parity packets carry an extra option in the same MSS
+            self.seg_size -= FEC_PARITY_LEN
+        self.cc = create_congestion_control(self.congestion, self.seg_size)
+        if self.journal is not None:
+            self.resume(packet.RESUME)
+
+    # skips the data the server says it already has (offset in RESUME_UNITs, None if it can't resume) and
+    # starts journaling
+    def resume(self, units):
+        journal = self.journal
+        if units is None:
+            print("Server doesn't support resuming, sending the whole file.")
+        elif units * RESUME_UNIT > journal.identity['size']:
+            self.abort("Server's resume offset {} is past the end of the file.".format(units * RESUME_UNIT))
+        elif units:
+            self.resume_offset = units * RESUME_UNIT
+            print("Resuming at byte {} of {} (journal had {}).".format(self.resume_offset, journal.identity['size'],
+                                                                      journal.acked))
+            self.source.close()
+            self.source = TCPyResumedSource(open(self.FILENAME, "rb"), self.resume_offset)
+        journal.update(self.resume_offset)
+        journal.start()
+
+    # the timestamps option for an outgoing packet, if timestamps were negotiated
+    def timestamp_option(self):
+        return pkt.timestamp_option(ts_now(), self.ts_recent) if self.ts_ok else b''
+
+    # resends the SYN with the timer backed off, giving up after MAX_SYN_RETRIES
+    def retransmit_syn(self):
+        if self.syn_retries >= MAX_SYN_RETRIES:
+            self.abort("Timed out while waiting for ack to SYN.")
+        self.syn_retries += 1
+        self.rto.backoff()
+        if not self.send_syn():
+            self.abort("Unable to send SYN packet.")
+
+    # sends the FIN and moves to FIN-WAIT-1 once the whole file has been sent, returns True if it did
+    def finish_sending(self):
+        if not self.source.at_end(self.SEQ_VARS['SND.NXT'] - self.SEQ_VARS['ISS'] - 1):
+            return False
+        # the last, partial, FEC block gets its parity too
+        if self.fec is not None and self.fec.count:
+            self.send_parity()
+        if not self.send_fin():
+            self.abort("Error sending FIN.")
+        self.CURR_STATE = 'FIN-WAIT-1'
+        return True
+
+    # seconds to wait for ACKs - until the next retransmission timer, or sooner if the pacer is holding a packet
+    def ack_wait_time(self):
+        timeout = self.timer_wait_time()
+        if self.pace_wait is not None and (timeout is None or self.pace_wait < timeout):
+            return self.pace_wait
+        return timeout
+
+    # seconds until the next retransmission timer, or a lost packet waiting on FEC parity, runs out
+    def timer_wait_time(self):
+        timeout = self.retrans_queue.time_left()
+        if self.fec is not None and self.fec.deferred:
+            fec_wait = self.fec.time_left(now(), self.rebuild_wait())
+            if fec_wait is not None and (timeout is None or fec_wait < timeout):
+                return fec_wait
+        return timeout
+
+    # sends as much new data as the window (and the pacer) allows, starting each packet's retransmission timer
+    def send_new_data(self):
+        # grab the next bytes available to send - may be nothing if we didn't get an increase in window size
+        start_index = self.SEQ_VARS['SND.NXT'] - self.SEQ_VARS['ISS'] - 1
+        end_index = (self.SEQ_VARS['SND.UNA'] + self.SEQ_VARS['RCV.WND']) - self.SEQ_VARS['ISS'] - 1
+        options = self.timestamp_option()
+        pacer = self.pacer
+        self.pace_wait = None
+        if pacer is not None:
+            pacer.update(self.cc.cwnd, self.cc.ssthresh, self.rto.srtt, self.seg_size)
+        # the congestion window caps how much of that may be in flight at once
+        while start_index < end_index and self.scoreboard.in_flight < self.cc.cwnd:
+            length = min(self.seg_size, end_index - start_index)
+            if pacer is not None:
+                wait = pacer.delay(length, now())
+                if wait:
+                    self.pace_wait = wait
+                    break
+            chunk = self.source.read(start_index, length)
+            if len(chunk) == 0:
+                break
+            payload_sum = self.source.payload_sum(start_index, len(chunk))
+            start_index += len(chunk)
+            # only the header is built - the payload stays a view of the source and goes out alongside it
+            header = self.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
+                                source_port=self.SOURCE_PORT, dest_port=self.DEST_PORT,
+                                seq_num=self.SEQ_VARS['SND.NXT'], data=chunk, options=options,
+                                payload_sum=payload_sum, header_only=True)
+            # send the packets and handle errors
+            try:
+                start_time = now()
+                self.send_segment(header, chunk)
+                # add packet to the scoreboard with its timer (keyed by its first sequence number) and update SND.NXT
+                seq_num = self.SEQ_VARS['SND.NXT']
+                self.scoreboard.add(seq_num, seq_num + len(chunk), header, start_time)
+                self.retrans_queue.schedule(seq_num, start_time + self.rto.rto)
+                self.SEQ_VARS['SND.NXT'] += len(chunk)
+                if self.fec is not None and self.fec.add(seq_num, chunk):
+                    self.send_parity()
+                if pacer is not None:
+                    delay = pacer.sent(len(chunk), start_time)
+                    if delay and self.telemetry is not None:
+                        self.telemetry.count('paced_packets')
+                        self.telemetry.observe('pacing_delay', delay)
+                if self.telemetry is not None:
+                    self.telemetry.count('packets_sent')
+                    self.telemetry.count('bytes_sent', len(chunk))
+                    self.telemetry.event('send', seq=seq_num, len=len(chunk))
+            except s.timeout:
+                self.abort("Error sending packet (seq = {}).".format(self.SEQ_VARS['SND.NXT']))
+
+    # retransmits every packet whose timer has expired and backs off the RTO
+    def retransmit_expired(self):
+        current_time = now()
+        if self.fec is not None and self.fec.deferred:
+            una = self.SEQ_VARS['SND.UNA']
+            for segment in self.fec.overdue(una, una, current_time, self.rebuild_wait()):
+                self.retransmit(segment, current_time, 'fast')
+        expired = self.retrans_queue.pop_expired(current_time)
+        if not expired:
+            return
+        # a single timeout event backs off and collapses the congestion window once, however many packets it covers
+        self.rto.backoff()
+        self.cc.on_timeout(self.scoreboard.in_flight, current_time)
+        if self.telemetry is not None:
+            self.telemetry.count('timeouts')
+            self.telemetry.event('timeout', rto=self.rto.rto, packets=len(expired), cwnd=self.cc.cwnd)
+        for k in expired:
+            segment = self.scoreboard.find(k)
+            if segment is not None and not segment.sacked:
+                if segment.retransmits >= MAX_RETRIES:
+                    self.abort("Timed out after retransmitting a packet {} times (seq = {}).".format(
+                        segment.retransmits, segment.start))
+                self.retransmit(segment, current_time)
+
+    # sends the parity packet for the open FEC block - parity isn't tracked or retransmitted, if it is lost the
+    # block's lost packets are retransmitted as they would be without FEC
+    def send_parity(self):
+        start, length, count, payload = self.fec.close_block(self.SEQ_VARS['SND.NXT'], now())
+        header = self.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
+                                     source_port=self.SOURCE_PORT, dest_port=self.DEST_PORT, seq_num=start,
+                                     data=payload, options=self.timestamp_option() + pkt.parity_option(length, count),
+                                     header_only=True)
+        try:
+            self.send_segment(header, payload)
+        except s.timeout:
+            self.abort("Error sending parity packet (seq = {}).".format(start))
+        if self.telemetry is not None:
+            self.telemetry.count('parity_sent')
+            self.telemetry.event('parity', seq=start, len=length, packets=count)
+
+    # sends a packet given as its header and payload - sendmsg() gathers the two into one datagram without
+    # copying the payload, otherwise they are joined for sendall()
+    def send_segment(self, header, payload):
+        if self.sendmsg is not None:
+            self.sendmsg((header, payload))
+        else:
+            self.sock.sendall(header + payload)
+
+    # resends an unack'ed packet and restarts its timer, cause is 'timeout' or 'fast'. The payload is read from
+    # the source again, which holds everything from SND.UNA on
+    def retransmit(self, segment, current_time, cause='timeout'):
+        try:
+            if self.ts_ok:
+                pkt.restamp(segment.header, ts_now())
+            offset = segment.start - self.SEQ_VARS['ISS'] - 1
+            self.send_segment(segment.header, self.source.read(offset, segment.end - segment.start))
+            segment.sent_time = current_time
+            segment.retransmits += 1
+            self.retrans_queue.schedule(segment.start, current_time + self.rto.rto)
+            if self.telemetry is not None:
+                self.telemetry.count('retransmits.' + cause)
+                self.telemetry.event('retransmit', seq=segment.start, len=segment.end - segment.start,
+                                     retransmits=segment.retransmits, cause=cause)
+        except s.timeout:
+            self.abort("Error retransmitting expired packet (seq = {}).".format(segment.start))
+
+    # waits up to timeout seconds (forever if None) for packets, then drains every datagram already queued on the
+    # socket without blocking and unpacks them as one batch, raises socket.timeout if none came. Python has no
+    # recvmmsg(), so each datagram is still one recvfrom_into(), but into reused buffers and with one wakeup,
+    # one window update and one pass over the unack'ed packets per batch
+    def receive_packets(self, timeout):
+        if timeout is not None and not select.select([self.sock], [], [], timeout)[0]:
+            raise s.timeout()
+        if self.recv_views is None:
+            buffer = memoryview(bytearray(RECV_BATCH * RECV_SLOT))
+            self.recv_views = [buffer[i * RECV_SLOT : (i + 1) * RECV_SLOT] for i in range(RECV_BATCH)]
+        packets = []
+        flags = 0
+        for view in self.recv_views:
+            if packets and not MSG_DONTWAIT and not select.select([self.sock], [], [], 0)[0]:
+                break
+            try:
+                nbytes, address = self.sock.recvfrom_into(view, 0, flags)
+            except BlockingIOError:
+                break
+            flags = MSG_DONTWAIT
+            packets.append(self.unpack_packet(self.SOURCE_ADDRESS, self.DEST_ADDRESS, view[:nbytes]))
+        return packets
+
+    # handles a batch of incoming ACKs - marks the packets they cover on the scoreboard, stopping their timers,
+    # taking RTT samples and growing the congestion window, then slides the send window once for the whole batch.
+    # ACK numbers are 32 bits on the wire and unwrapped against SND.UNA. Once DUP_ACK_THRESHOLD packets are
+    # SACK'ed above a hole the packets in it are taken as lost and fast retransmitted
+    def process_acks(self, packets):
+        current_time = now()
+        scoreboard = self.scoreboard
+        una = self.SEQ_VARS['SND.UNA']
+        last_ack = None
+        acked = []
+        # highest sequence number ACK'ed or SACK'ed in the batch, and whether anything above a hole had been
+        # SACK'ed before it, for FEC
+        high_acked = una
+        holes = scoreboard.sacked > 0
+        for rec_packet in packets:
+            if not rec_packet or not rec_packet.ACK:
+                print("ERROR({}): Packet received was not an ACK.".format(self.CURR_STATE))
+                continue
+            last_ack = rec_packet
+            ack_num = pkt.unwrap_seq(una, rec_packet.ACK_NUM)
+            high_acked = max(high_acked, ack_num)
+            if self.sack_ok:
+                newly_acked = scoreboard.ack(ack_num)
+                for left, right in rec_packet.SACK:
+                    right = pkt.unwrap_seq(una, right)
+                    newly_acked += scoreboard.sack(pkt.unwrap_seq(una, left), right)
+                    high_acked = max(high_acked, right)
+            else:
+                # per-packet ACKs - the ACK number is the end of the one packet received
+                newly_acked = scoreboard.sack_segment(ack_num)
+            if rec_packet.TS is not None:
+                self.ts_recent = rec_packet.TS[0]
+                # the echoed timestamp dates the copy that got through, so retransmitted packets can be timed too
+                if any(segment.retransmits for segment in newly_acked):
+                    self.sample_rtt(ts_elapsed(rec_packet.TS[1]))
+            acked += newly_acked
+        if last_ack is None:
+            return
+        if not self.sack_ok:
+            scoreboard.ack(una, skip_sacked=True)
+
+        # ACKs for packets no longer outstanding (e.g. both copies of a retransmitted packet) only update the window
+        self.SEQ_VARS['SND.UNA'] = scoreboard.una if scoreboard else self.SEQ_VARS['SND.NXT']
+        for segment in acked:
+            self.retrans_queue.cancel(segment.start)
+            # Karn's rule - only packets sent exactly once give an unambiguous RTT sample
+            if segment.retransmits == 0:
+                self.sample_rtt(current_time - segment.sent_time)
+            self.cc.on_ack(segment.end - segment.start, self.SEQ_VARS['SND.UNA'], current_time, self.rto.srtt)
+        lost = scoreboard.detect_losses()
+        if lost:
+            self.cc.on_loss(scoreboard.in_flight, self.SEQ_VARS['SND.NXT'], current_time)
+            if self.telemetry is not None:
+                self.telemetry.count('losses')
+                self.telemetry.event('loss', packets=len(lost), cwnd=self.cc.cwnd, ssthresh=self.cc.ssthresh)
+            flush = False
+            for segment in lost:
+                # with FEC the server may rebuild the packet from its block's parity, so it waits on that first
+                if self.fec is not None and self.fec.protects(segment):
+                    self.fec.deferred.append(segment)
+                    # its timer restarts as a retransmission's would, so it doesn't run out before the parity is in
+                    self.retrans_queue.schedule(segment.start, current_time + self.rto.rto)
+                    flush = flush or self.fec.find(segment) is None
+                    if self.telemetry is not None:
+                        self.telemetry.count('fec_deferred')
+                else:
+                    self.retransmit(segment, current_time, 'fast')
+            # a loss in the open block shouldn't wait for the block to fill up, its parity goes out now
+            if flush:
+                self.send_parity()
+        if self.fec is not None:
+            # packets filling a hole without being retransmitted were most likely rebuilt from parity - losses
+            # the server got over, which the block size should still account for
+            late = sum(1 for segment in acked if not segment.sacked and not segment.retransmits) if holes else 0
+            self.process_fec(len(lost) + late, len(acked), high_acked, current_time)
+        prev_wnd = self.SEQ_VARS['RCV.WND']
+        self.SEQ_VARS['RCV.NXT'] = last_ack.ACK_NUM # RCV.NXT updated to next expected seg
+        self.SEQ_VARS['RCV.WND'] = last_ack.WINDOW << self.snd_wscale
+        # data below SND.UNA has all been ACK'ed, the source can drop it
+        self.source.release(self.SEQ_VARS['SND.UNA'] - self.SEQ_VARS['ISS'] - 1)
+        if self.journal is not None:
+            self.journal.update(self.resume_offset + self.SEQ_VARS['SND.UNA'] - self.SEQ_VARS['ISS'] - 1)
+        if self.telemetry is not None:
+            self.record_ack_batch(len(packets), acked, prev_wnd)
+
+    # seconds a lost packet waits after its block's parity was sent for the server to rebuild it
+    def rebuild_wait(self):
+        return REBUILD_WAIT * (self.rto.srtt if self.rto.srtt is not None else self.rto.rto)
+
+    # updates FEC with an ACK batch, retransmitting the lost packets the server couldn't rebuild
+    def process_fec(self, lost, acked, high_acked, current_time):
+        fec = self.fec
+        recovered = fec.recovered
+        for segment in fec.overdue(self.SEQ_VARS['SND.UNA'], high_acked, current_time, self.rebuild_wait()):
+            self.retransmit(segment, current_time, 'fast')
+        fec.observe(lost, acked, self.SEQ_VARS['SND.UNA'])
+        if self.telemetry is not None:
+            self.telemetry.count('fec_recovered', fec.recovered - recovered)
+
+    # feeds an RTT sample to the RTO estimate
+    def sample_rtt(self, rtt):
+        self.rto.sample(rtt)
+        if self.telemetry is not None:
+            self.telemetry.observe('rtt', rtt)
+
+    # telemetry for one batch of ACKs - what they ACK'ed, and the flight size and windows they leave behind
+    def record_ack_batch(self, acks, acked, prev_wnd):
+        telemetry = self.telemetry
+        telemetry.count('acks', acks)
+        telemetry.observe('ack_batch', acks)
+        for segment in acked:
+            telemetry.observe('retransmits_per_packet', segment.retransmits)
+            telemetry.count('bytes_acked', segment.end - segment.start)
+        telemetry.count('packets_acked', len(acked))
+        telemetry.observe('bytes_in_flight', self.scoreboard.in_flight)
+        telemetry.observe('cwnd', self.cc.cwnd)
+        telemetry.event('ack', una=self.SEQ_VARS['SND.UNA'], nxt=self.SEQ_VARS['SND.NXT'],
+                        in_flight=self.scoreboard.in_flight, cwnd=self.cc.cwnd, rcv_wnd=self.SEQ_VARS['RCV.WND'])
+        if self.SEQ_VARS['RCV.WND'] != prev_wnd:
+            telemetry.count('window_updates')
+            telemetry.event('window', rcv_wnd=self.SEQ_VARS['RCV.WND'])
+
     # helper function for sending a FIN packet
     def send_fin(self):
-        packet = pkt.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
+        packet = self.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
                                     source_port=self.SOURCE_PORT, dest_port=self.DEST_PORT, 
-                                    seq_num=self.SEQ_VARS['SND.NXT'], fin=True)
+                                    seq_num=self.SEQ_VARS['SND.NXT'], fin=True, options=self.timestamp_option())
         try:
-            self.sock.sendall(packet.bytes)
+            self.sock.sendall(packet)
             return True
         except s.timeout:
             return False
 
     # helper function for sending a SYN packet
     def send_syn(self):
-        packet = pkt.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
+        packet = self.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
                                     source_port=self.SOURCE_PORT, dest_port=self.DEST_PORT, 
-                                    seq_num=self.SEQ_VARS['ISS'], syn=True)
+                                    seq_num=self.SEQ_VARS['ISS'], syn=True, options=self.syn_options())
         try:
-            self.sock.sendall(packet.bytes)
+            self.sock.sendall(packet)
+            self.syn_time = now()
             return True
         except s.timeout:
             return False
     
+    # the options offered in the SYN - the client never receives data, so its own window scale is 0
+    def syn_options(self):
+        options = (pkt.timestamp_option(ts_now(), 0) + pkt.mss_option(self.local_mss) +
+                   pkt.window_scale_option(0) + pkt.sack_permitted_option())
+        if self.FEC is not None:
+            options += pkt.fec_option(MAX_BLOCK if self.FEC == 'auto' else self.FEC)
+        if self.journal is not None:
+            options += pkt.resume_option(self.journal.token)
+        return options
+
     # helper function for sending ACK packet
     def send_ack(self, num_to_ack):
-        packet = pkt.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
+        packet = self.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=self.DEST_ADDRESS,
                                        source_port=self.SOURCE_PORT, dest_port=self.DEST_PORT, 
                                        seq_num=self.SEQ_VARS['SND.NXT'], ack_num=num_to_ack,
-                                       ack=True, window=0)
+                                       ack=True, window=0, options=self.timestamp_option())
         try:
-            self.sock.sendall(packet.bytes)
+            self.sock.sendall(packet)
             return True
         except s.timeout:
             return False
@@ -271,10 +673,18 @@ class TCPyClient:
     def send(self):
         print("SENDING: File = {} To: {}:{}".format(self.FILENAME, self.DEST_ADDRESS, self.DEST_PORT))
         while self.CURR_STATE != 'DONE':
-            self.TCP_STATES[self.CURR_STATE]()
+            state = self.CURR_STATE
+            self.TCP_STATES[state]()
+            if self.telemetry is not None and self.CURR_STATE != state:
+                self.telemetry.event('state', state=self.CURR_STATE)
             
         print("Done sending, closing connection.")
+        self.source.close()
         self.sock.close()
+        if self.journal is not None:
+            self.journal.close(done=True)
+        if self.telemetry is not None:
+            self.telemetry.close()
         return
 
 class Main:
@@ -282,29 +692,147 @@ class Main:
     # Parsing for argument flags
     parser = argparse.ArgumentParser()
     parser.add_argument("-a", required=True, type=str, help="supply a destination address")
-    parser.add_argument("-f", required=True, type=str, help="supply a filename in string format")
+    # one file, or a session of many sent back to back over the same connection
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("-f", type=str, help="supply a filename in string format ('-' for stdin)")
+    source_group.add_argument("-d", type=str, help="send every file under a directory as one session")
+    source_group.add_argument("-g", type=str, help="send every file matching a glob pattern as one session")
+    source_group.add_argument("-m", type=str, help="send the files listed in a manifest ('-' for stdin) as one session")
     parser.add_argument("-cp", required=True, type=int, help="supply client port information")
     parser.add_argument("-sp", required=True, type=int, help="supply server port information")
+    parser.add_argument("-cc", default='reno', choices=sorted(CONGESTION_CONTROLS), help="congestion control algorithm")
+    parser.add_argument("-mss", default=None, type=int, help="largest segment to offer (default: from the path MTU)")
+    parser.add_argument("-trace", default=None, type=str,
+                        help="write a trace of the connection (.pcap for a packet capture, JSON lines otherwise)")
+    parser.add_argument("-stats", action="store_true", help="print the connection's telemetry when done")
+    parser.add_argument("-pace", default=None, type=str,
+                        help="pace packets at a rate in bytes/s (K, M, G suffixes) or 'auto' for cwnd / RTT")
+    parser.add_argument("-fec", default=None, type=str,
+                        help="offer FEC with a parity packet per this many packets, or 'auto' to adapt to loss")
+    parser.add_argument("-resume", nargs='?', const='', default=None, type=str,
+                        help="journal progress to a file (default: the file's name + {}) and resume from it "
+                             "if the transfer is cut short".format(JOURNAL_SUFFIX))
+    parser.add_argument("-workers", default=1, type=int,
+                        help="send over this many processes and client ports - a file is striped into ranges, "
+                             "a session's files are spread out")
 
-    args = parser.parse_args()
-
-    # setting server address and outputting value set to console
-    SERVER_ADDRESS = args.a
-    print("Server address:", SERVER_ADDRESS)
-    # setting filename and outputting value set to console
-    FILENAME = args.f
-    print("Filename:", FILENAME)
-    # checking for appropriate port numbers
-    # *** THIS IS MUCH PRETTIER THAN USING choices=range(5000, 65535) in add_argument()!!!!!!! ***
-    if args.cp < 5000 or args.cp > 65535:
-        parser.exit(message="\tERROR(args): Client port out of range\n")
-    CLIENT_PORT = args.cp
-    print("Client port:", CLIENT_PORT)
-    # checking for appropriate server port numbers
-    if args.sp < 5000 or args.sp > 65535:
-        parser.exit(message="\tERROR(args): Server port out of range\n")
-    SERVER_PORT = args.sp
-    print("Server port:", SERVER_PORT)
-    
-    tcp_client = TCPyClient(SERVER_ADDRESS, CLIENT_PORT, SERVER_PORT, FILENAME)
-    tcp_client.send()
+    def __init__(self, argv=None):
+        parser = self.parser
+        args = parser.parse_args(argv)
+
+        # setting server address and outputting value set to console
+        self.SERVER_ADDRESS = args.a
+        print("Server address:", self.SERVER_ADDRESS)
+        # setting filename (or session files) and outputting value set to console
+        self.FILENAME = args.f
+        files = None
+        if self.FILENAME is not None:
+            print("Filename:", self.FILENAME)
+        else:
+            # imported here so single file transfers don't pay for it at start-up
+            from TCPySession import list_files
+            try:
+                files = list_files(directory=args.d, pattern=args.g, manifest=args.m)
+            except OSError as e:
+                parser.exit(message="\tERROR(args): {}\n".format(e))
+            if not files:
+                parser.exit(message="\tERROR(args): No files to send\n")
+            print("Files:", len(files))
+        # checking for appropriate port numbers
+        # *** THIS IS MUCH PRETTIER THAN USING choices=range(5000, 65535) in add_argument()!!!!!!! ***
+        if args.cp < 5000 or args.cp > 65535:
+            parser.exit(message="\tERROR(args): Client port out of range\n")
+        self.CLIENT_PORT = args.cp
+        print("Client port:", self.CLIENT_PORT)
+        # checking for appropriate server port numbers
+        if args.sp < 5000 or args.sp > 65535:
+            parser.exit(message="\tERROR(args): Server port out of range\n")
+        self.SERVER_PORT = args.sp
+        print("Server port:", self.SERVER_PORT)
+        print("Congestion control:", args.cc)
+        if args.mss is not None and not TIMESTAMP_LEN < args.mss <= MAX_MSS:
+            parser.exit(message="\tERROR(args): MSS out of range\n")
+        pacing = None
+        if args.pace is not None:
+            try:
+                pacing = parse_rate(args.pace)
+            except ValueError:
+                parser.exit(message="\tERROR(args): Invalid pacing rate\n")
+            if pacing is None:
+                pacing = 'auto'
+            print("Pacing:", args.pace)
+        fec = args.fec
+        if fec is not None and fec != 'auto':
+            try:
+                fec = int(fec)
+            except ValueError:
+                fec = 0
+            if not 1 <= fec <= 0xFFFF:
+                parser.exit(message="\tERROR(args): Invalid FEC block size\n")
+        if fec is not None:
+            print("FEC:", fec)
+        resume = None
+        if args.resume is not None:
+            if self.FILENAME is None or not os.path.isfile(self.FILENAME) or args.workers > 1:
+                parser.exit(message="\tERROR(args): -resume needs a regular file (-f) and one worker\n")
+            resume = journal_path(self.FILENAME, args.resume)
+            print("Journal:", resume)
+        if args.workers > 1:
+            self.send_parallel(args, files, pacing, fec)
+            return
+
+        telemetry = None
+        if args.trace or args.stats:
+            from TCPyTelemetry import TCPyTelemetry, open_trace
+            telemetry = TCPyTelemetry([open_trace(args.trace)] if args.trace else [])
+
+        if files is None:
+            self.tcp_client = TCPyClient(self.SERVER_ADDRESS, self.CLIENT_PORT, self.SERVER_PORT, self.FILENAME,
+                                         congestion=args.cc, mss=args.mss, telemetry=telemetry, pacing=pacing,
+                                         fec=fec, resume=resume)
+        else:
+            from TCPySession import TCPySessionClient
+            self.tcp_client = TCPySessionClient(self.SERVER_ADDRESS, self.CLIENT_PORT, self.SERVER_PORT, files,
+                                                congestion=args.cc, mss=args.mss, telemetry=telemetry, pacing=pacing,
+                                                fec=fec)
+        self.tcp_client.send()
+        if self.tcp_client.pacer is not None:
+            import json
+            print("Pacing stats:", json.dumps(self.tcp_client.pacer.stats(), sort_keys=True))
+        if args.stats:
+            import json
+            print("Telemetry:", json.dumps(telemetry.summary(), sort_keys=True))
+
+    # sends the file or session over args.workers processes, exiting with an error if any share failed
+    def send_parallel(self, args, files, pacing, fec):
+        parser = self.parser
+        if args.trace:
+            parser.exit(message="\tERROR(args): Traces aren't supported with -workers\n")
+        from TCPyParallel import TCPyParallelTransfer, spread_files, stripe_file
+        if files is None:
+            if self.FILENAME == '-':
+                parser.exit(message="\tERROR(args): Can't stripe stdin across workers\n")
+            try:
+                shares = stripe_file(self.FILENAME, args.workers)
+            except OSError as e:
+                parser.exit(message="\tERROR(args): {}\n".format(e))
+        else:
+            shares = spread_files(files, args.workers)
+        if self.CLIENT_PORT + len(shares) - 1 > 65535:
+            parser.exit(message="\tERROR(args): Client ports out of range for {} workers\n".format(len(shares)))
+        print("Workers:", len(shares))
+        transfer = TCPyParallelTransfer(self.SERVER_ADDRESS, self.CLIENT_PORT, self.SERVER_PORT, shares,
+                                        congestion=args.cc, mss=args.mss, pacing=pacing, fec=fec, stats=args.stats)
+        summary = transfer.send()
+        print("Done sending, {} bytes in {:.2f}s ({:.2f} MB/s).".format(summary['bytes'], summary['elapsed'],
+                                                                         (summary['goodput'] or 0) / 1e6))
+        if args.stats:
+            import json
+            print("Parallel:", json.dumps(summary, sort_keys=True))
+        if not summary['ok']:
+            print("ERROR(parallel): {} of {} workers failed.".format(len(summary['failed']), summary['flows']))
+            exit(1)
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,552 @@
+# tcp_server.py
+"""
+This is a reference receiver for the TCPy client, speaking the same TCPyPacket format as the course
+server so the client can be run and measured entirely over loopback. By default every data segment is
+ACK'ed individually (ACK number = SEQ + length), the same selective ACK behaviour the course server has and
+the client's Selective Repeat implementation was built around. A client that offers SACK-permitted in its
+SYN instead gets cumulative ACKs carrying RFC 2018 SACK blocks for the data received past a hole. MSS,
+window scale and timestamps (RFC 7323) are agreed the same way - offered options are accepted, and a
+client that offers none is treated exactly like the course server would. Data is delivered in order to an
+output file (or only counted and hashed when no output is given). A client that asks for a session (see
+TCPySession) has its stream split back into files instead, written by name under the output directory.
+A client that offers FEC (see TCPyFec) gets it accepted, and a segment lost from a block is rebuilt from
+the block's parity segment when it is the only one missing. A client resuming a transfer (see TCPyJournal)
+is told how much of its output file the server already has, and only the rest is written after it.
+
+Network conditions are emulated by a TCPyImpairment on each direction - random loss, duplication,
+reordering, fixed delay with jitter, and a bandwidth cap with an optional drop-tail queue. Impairments
+apply to data segments and their ACKs; connection control segments (SYN, FIN and the handshake ACK)
+always go through, since the client never retransmits its FIN.
+"""
+import argparse
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import select
+import socket as s
+import threading
+import time
+
+from TCPyPacket import TCPyPacket as pkt
+from TCPyPacket import HEADER_LEN, MAX_MSS, MAX_WSCALE
+from TCPyFec import TCPyFecDecoder
+from TCPyJournal import RESUME_UNIT
+from TCPySession import TCPyFrameReader
+from TCPyTimer import ts_now
+
+# receive window - clients that don't scale windows are offered at most 64 KiB of it
+DEFAULT_WINDOW = 4 * 1024 * 1024
+# completed connections keep ACK'ing late retransmissions for this long before they are dropped
+LINGER_TIME = 2.0
+# a resumable transfer's output has a marker file with its token next to it, and what is kept of the output is
+# hashed in reads of this size
+RESUME_SUFFIX = '.tcpy-resume'
+RESUME_READ = 1024 * 1024
+
+
+# emulated network conditions for one direction of a connection
+class TCPyImpairment:
+
+    def __init__(self, loss=0.0, duplicate=0.0, reorder=0.0, reorder_delay=0.005, delay=0.0, jitter=0.0,
+                 bandwidth=None, queue=None, seed=None):
+        self.loss = loss                    # probability a datagram is dropped
+        self.duplicate = duplicate          # probability a datagram is delivered twice
+        self.reorder = reorder              # probability a datagram is held back by reorder_delay
+        self.reorder_delay = reorder_delay
+        self.delay = delay                  # one-way propagation delay in seconds
+        self.jitter = jitter                # uniform +/- variation on the delay
+        self.bandwidth = bandwidth          # bytes per second, None for unlimited
+        self.queue = queue                  # bytes that may wait for the link before drop-tail, None for unlimited
+        self.random = random.Random(seed)
+        self.link_free = 0.0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+    def __repr__(self):
+        return "TCPyImpairment({})".format(", ".join("{}={}".format(k, v) for (k, v) in self.settings().items()))
+
+    def settings(self):
+        return {'loss': self.loss, 'duplicate': self.duplicate, 'reorder': self.reorder, 'delay': self.delay,
+                'jitter': self.jitter, 'bandwidth': self.bandwidth, 'queue': self.queue}
+
+    # returns the times at which a datagram of the given size sent at current_time arrives - empty if it is lost
+    def schedule(self, size, current_time):
+        rand = self.random.random
+        if self.loss and rand() < self.loss:
+            self.dropped += 1
+            return []
+        depart = current_time
+        if self.bandwidth:
+            start = max(current_time, self.link_free)
+            if self.queue is not None and (start - current_time) * self.bandwidth > self.queue:
+                self.dropped += 1
+                return []
+            self.link_free = start + size / self.bandwidth
+            depart = self.link_free
+        arrival = depart + self.delay
+        if self.jitter:
+            arrival += self.random.uniform(-self.jitter, self.jitter)
+        if self.reorder and rand() < self.reorder:
+            self.reordered += 1
+            arrival += self.reorder_delay
+        arrivals = [max(arrival, current_time)]
+        if self.duplicate and rand() < self.duplicate:
+            self.duplicated += 1
+            arrivals.append(arrivals[0] + self.random.uniform(0, self.reorder_delay))
+        return arrivals
+
+
+# receive side of one client connection
+class TCPyServerConnection:
+
+    def __init__(self, server, address, syn):
+        self.server = server
+        self.address = address
+        self.CLIENT_PORT = syn.S_PORT
+        self.IRS = syn.SEQ_NUM
+        self.SACK_OK = syn.SACK_PERM  # cumulative ACKs with SACK blocks instead of one ACK per segment
+        # window scale is only used if the client offered it, and then the server picks the shift its window needs
+        self.RCV_WSCALE = None
+        if syn.WSCALE is not None:
+            self.RCV_WSCALE = min(max(server.WINDOW.bit_length() - 16, 0), MAX_WSCALE)
+        self.TS_OK = syn.TS is not None
+        self.TS_RECENT = syn.TS[0] if self.TS_OK else 0
+        self.SESSION = syn.SESSION
+        self.FEC = syn.FEC          # largest FEC block the client will send, None without FEC
+        self.fec = TCPyFecDecoder(self.FEC) if self.FEC else None
+        # the client's transfer token if it asked to resume (never for a session), and where in the output file
+        # this connection's data starts
+        self.RESUME = None if self.SESSION else syn.RESUME
+        self.RESUME_OFFSET = 0
+        self.resume_marker = None
+        self.ISS = int(time.time()) % 2**32
+        self.RCV_NXT = 0            # next in-order byte offset expected
+        self.FIN_OFFSET = None      # byte offset of the FIN once it has been seen
+        self.out_of_order = {}      # offset -> payload for segments past a hole
+        self.digest = hashlib.sha256()
+        self.sink = None if self.SESSION else server.open_output(self)
+        self.frames = None
+        if self.SESSION:
+            self.frames = TCPyFrameReader(lambda name, offset, total: server.open_session_file(self, name, offset, total))
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.segments = 0           # data segments that reached the receiver
+        self.duplicates = 0         # of those, ones already received before
+        self.bytes_delivered = 0
+
+    @property
+    def complete(self):
+        return self.FIN_OFFSET is not None and self.RCV_NXT >= self.FIN_OFFSET
+
+    # byte offset in the stream of a sequence number
+    def offset(self, seq_num):
+        return (seq_num - self.IRS - 1) % 2**32
+
+    def handle(self, packet):
+        if packet.SYN:
+            return
+        data = packet.DATA
+        # RFC 7323 - echo the timestamp of the segment that last advanced RCV.NXT, not of later out of order ones
+        if self.TS_OK and packet.TS is not None and self.offset(packet.SEQ_NUM) <= self.RCV_NXT:
+            self.TS_RECENT = packet.TS[0]
+        if packet.FIN:
+            self.FIN_OFFSET = self.offset(packet.SEQ_NUM)
+            if self.SACK_OK:
+                # cumulative ACKs can't cover the FIN until everything before it has arrived
+                ack_num = self.IRS + 1 + self.RCV_NXT + (1 if self.complete else 0)
+                self.server.send_control(self, ack_num=ack_num, sack=self.sack_blocks(self.FIN_OFFSET))
+            else:
+                self.server.send_control(self, ack_num=packet.SEQ_NUM + 1)
+            self.check_complete()
+            return
+        if not len(data):
+            # the handshake ACK is itself ACK'ed
+            if packet.ACK:
+                self.server.send_control(self, ack_num=self.IRS + 1)
+            return
+        offset = self.offset(packet.SEQ_NUM)
+        if packet.PARITY is not None:
+            # parity isn't data - it is only ACK'ed through the segment it rebuilds, if any
+            if self.fec is not None:
+                rebuilt = self.fec.add_parity(offset, packet.PARITY[0], packet.PARITY[1], bytes(data))
+                if rebuilt is not None:
+                    self.receive_segment(*rebuilt)
+                    self.check_complete()
+            return
+        self.segments += 1
+        self.receive_segment(offset, data)
+        if self.fec is not None:
+            for rebuilt in self.fec.check(offset):
+                self.receive_segment(*rebuilt)
+        self.check_complete()
+
+    # takes in a data segment (received or rebuilt) at offset and ACKs it
+    def receive_segment(self, offset, data):
+        if offset < self.RCV_NXT or offset in self.out_of_order:
+            self.duplicates += 1
+        else:
+            if self.fec is not None:
+                data = bytes(data)
+                self.fec.add(offset, data)
+            if offset == self.RCV_NXT:
+                self.deliver(data)
+                # pull any buffered segments that are now in order
+                while self.RCV_NXT in self.out_of_order:
+                    self.deliver(self.out_of_order.pop(self.RCV_NXT))
+                if self.fec is not None:
+                    self.fec.prune(self.RCV_NXT)
+            else:
+                self.out_of_order[offset] = bytes(data)
+        if self.SACK_OK:
+            self.server.send_ack(self, ack_num=self.IRS + 1 + self.RCV_NXT, sack=self.sack_blocks(offset))
+        else:
+            self.server.send_ack(self, ack_num=self.IRS + 1 + offset + len(data))
+
+    # SACK blocks for the out of order data, as sequence numbers - the block holding the segment just
+    # received comes first (RFC 2018), then the others from the highest down
+    def sack_blocks(self, offset):
+        blocks = []
+        for start in sorted(self.out_of_order):
+            end = start + len(self.out_of_order[start])
+            if blocks and blocks[-1][1] == start:
+                blocks[-1][1] = end
+            else:
+                blocks.append([start, end])
+        blocks.sort(key=lambda block: (not block[0] <= offset < block[1], -block[0]))
+        base = self.IRS + 1
+        return [(base + start, base + end) for start, end in blocks]
+
+    def deliver(self, data):
+        self.digest.update(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        elif self.frames is not None:
+            self.frames.feed(data)
+        self.RCV_NXT += len(data)
+        self.bytes_delivered += len(data)
+
+    def check_complete(self):
+        if self.complete and self.end_time is None:
+            self.end_time = time.monotonic()
+            if self.sink is not None:
+                self.sink.close()
+            self.server.completed(self)
+
+    def stats(self):
+        stats = {
+            'client_port': self.CLIENT_PORT,
+            'bytes': self.bytes_delivered,
+            'complete': self.complete,
+            'sha256': self.digest.hexdigest(),
+            'completion_time': (self.end_time or time.monotonic()) - self.start_time,
+            'transmissions': self.server.transmissions.get(self.address, 0),
+            'segments': self.segments,
+            'duplicates': self.duplicates,
+        }
+        if self.RESUME is not None:
+            stats['resumed_from'] = self.RESUME_OFFSET
+        if self.fec is not None:
+            stats['parity_segments'] = self.fec.parity
+            stats['fec_recovered'] = self.fec.recovered
+        if self.frames is not None:
+            stats['files'] = [{'name': name, 'size': size, 'sha256': digest} for name, size, digest, offset, total in
+                              self.frames.files]
+            for entry, (name, size, digest, offset, total) in zip(stats['files'], self.frames.files):
+                if offset is not None:
+                    entry['offset'] = offset
+                    entry['total'] = total
+                    # the file a range went into should be exactly the size its frame gave
+                    file_size = self.server.session_file_size(self, name)
+                    if file_size is not None and file_size != total:
+                        entry['file_size'] = file_size
+                        stats['error'] = "{} is {} bytes, expected {}".format(name, file_size, total)
+            if self.frames.error is not None:
+                stats['error'] = self.frames.error
+        return stats
+
+
+class TCPyServer:
+
+    def __init__(self, address='', port=0, window=DEFAULT_WINDOW, impairment=None, return_impairment=None,
+                 output=None, on_complete=None, mss=MAX_MSS):
+        self.sock = s.socket(s.AF_INET, s.SOCK_DGRAM)
+        # room for a full window of datagrams while the event loop catches up (the kernel may cap it lower)
+        self.sock.setsockopt(s.SOL_SOCKET, s.SO_RCVBUF, window)
+        self.sock.bind((address, port))
+        self.SOURCE_ADDRESS = self.sock.getsockname()[0] or '0.0.0.0'
+        self.PORT = self.sock.getsockname()[1]
+        self.WINDOW = window
+        self.MSS = mss
+        # data direction (client -> server) and ACK direction (server -> client)
+        self.impairment = impairment or TCPyImpairment()
+        self.return_impairment = return_impairment or TCPyImpairment(**self.impairment.settings())
+        self.output = output
+        self.on_complete = on_complete
+        self.connections = {}
+        self.finished = []
+        self.events = []            # (time, order, kind, payload, address) heap of delayed datagrams
+        self.order = itertools.count()
+        self.running = False
+        self.thread = None
+        # data datagrams sent by each client as they left it, before any impairment
+        self.transmissions = {}
+
+    #                               EVENT LOOP
+    ############################################################################################
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            timeout = 0.1
+            if self.events:
+                timeout = min(max(self.events[0][0] - time.monotonic(), 0), timeout)
+            if select.select([self.sock], [], [], timeout)[0]:
+                try:
+                    bytes_packet, address = self.sock.recvfrom(65536)
+                except OSError:
+                    continue
+                self.ingress(bytes_packet, address)
+            self.run_events()
+            self.expire_connections()
+        self.sock.close()
+
+    # runs the server in a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="tcpy-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    # passes an arriving datagram through the data direction impairment
+    def ingress(self, bytes_packet, address):
+        current_time = time.monotonic()
+        # too short to be a segment at all - dropped before anything reads its header
+        if len(bytes_packet) < HEADER_LEN:
+            return
+        if self.is_control(bytes_packet):
+            self.receive(bytes_packet, address)
+            return
+        self.transmissions[address] = self.transmissions.get(address, 0) + 1
+        for arrival in self.impairment.schedule(len(bytes_packet), current_time):
+            if arrival <= current_time:
+                self.receive(bytes_packet, address)
+            else:
+                heapq.heappush(self.events, (arrival, next(self.order), 'in', bytes_packet, address))
+
+    # sends a datagram through the ACK direction impairment
+    def egress(self, bytes_packet, address, control=False):
+        current_time = time.monotonic()
+        arrivals = [current_time] if control else self.return_impairment.schedule(len(bytes_packet), current_time)
+        for arrival in arrivals:
+            if arrival <= current_time:
+                self.sock.sendto(bytes_packet, address)
+            else:
+                heapq.heappush(self.events, (arrival, next(self.order), 'out', bytes_packet, address))
+
+    def run_events(self):
+        current_time = time.monotonic()
+        while self.events and self.events[0][0] <= current_time:
+            arrival, order, kind, bytes_packet, address = heapq.heappop(self.events)
+            if kind == 'in':
+                self.receive(bytes_packet, address)
+            else:
+                self.sock.sendto(bytes_packet, address)
+
+    # SYN, FIN and empty ACK segments bypass the impairments
+    def is_control(self, bytes_packet):
+        # no payload past the header and its options
+        return len(bytes_packet) <= max((bytes_packet[12] >> 4) * 4, 20) or bytes_packet[13] & 0x03
+
+    #                               PROTOCOL
+    ############################################################################################
+    def receive(self, bytes_packet, address):
+        packet = pkt.unpack_packet(address[0], self.SOURCE_ADDRESS, bytes_packet)
+        if packet is None:
+            return
+        conn = self.connections.get(address)
+        if packet.SYN:
+            if conn is None or conn.IRS != packet.SEQ_NUM:
+                conn = TCPyServerConnection(self, address, packet)
+                self.connections[address] = conn
+            self.send_control(conn, ack_num=packet.SEQ_NUM + 1, syn=True)
+            return
+        if conn is not None:
+            conn.handle(packet)
+
+    def send_ack(self, conn, ack_num, sack=None):
+        self.egress(self.package(conn, ack_num, sack=sack), conn.address)
+
+    def send_control(self, conn, ack_num, syn=False, sack=None):
+        self.egress(self.package(conn, ack_num, syn=syn, sack=sack), conn.address, control=True)
+
+    def package(self, conn, ack_num, syn=False, sack=None):
+        options = pkt.timestamp_option(ts_now(), conn.TS_RECENT) if conn.TS_OK else b''
+        if syn:
+            # the SYN/ACK answers each option the client offered
+            options += pkt.mss_option(self.MSS)
+            if conn.RCV_WSCALE is not None:
+                options += pkt.window_scale_option(conn.RCV_WSCALE)
+            if conn.SACK_OK:
+                options += pkt.sack_permitted_option()
+            if conn.SESSION:
+                options += pkt.session_option()
+            if conn.FEC:
+                options += pkt.fec_option(conn.FEC)
+            if conn.RESUME is not None:
+                options += pkt.resume_option(conn.RESUME_OFFSET // RESUME_UNIT)
+        elif sack:
+            options += pkt.sack_option(sack, 3 if conn.TS_OK else 4)
+        # windows in a SYN are never scaled
+        window = self.WINDOW if syn or conn.RCV_WSCALE is None else self.WINDOW >> conn.RCV_WSCALE
+        return bytes(pkt.package_packet(source_address=self.SOURCE_ADDRESS, dest_address=conn.address[0],
+                                        source_port=self.PORT, dest_port=conn.CLIENT_PORT,
+                                        seq_num=conn.ISS if syn else (conn.ISS + 1) % 2**32,
+                                        ack_num=ack_num % 2**32, ack=True, syn=syn, window=min(window, 0xFFFF),
+                                        options=options))
+
+    #                               OUTPUT AND BOOKKEEPING
+    ############################################################################################
+    # opens where a connection's data goes - one file per client port when output is a directory, or per
+    # transfer token when the client may resume it
+    def open_output(self, conn):
+        if self.output is None:
+            return None
+        path = self.output
+        if os.path.isdir(self.output):
+            name = "tcpy_{:08x}.bin".format(conn.RESUME) if conn.RESUME else "tcpy_{}.bin".format(conn.CLIENT_PORT)
+            path = os.path.join(self.output, name)
+        if conn.RESUME is not None:
+            return self.open_resumed(conn, path)
+        return open(path, "wb")
+
+    # opens the output of a transfer that may be resumed, keeping what an earlier connection with the same token
+    # wrote (down to a whole RESUME_UNIT) and hashing it into the connection's digest. A marker file next to the
+    # output holds the token until the transfer completes
+    def open_resumed(self, conn, path):
+        # an earlier connection of the transfer still open here lets go of the file first
+        self.drop_transfer(conn)
+        marker = path + RESUME_SUFFIX
+        offset = 0
+        try:
+            with open(marker) as f:
+                if int(f.read(), 16) == conn.RESUME:
+                    offset = os.path.getsize(path) // RESUME_UNIT * RESUME_UNIT
+        except (OSError, ValueError):
+            pass
+        with open(marker, "w") as f:
+            f.write("{:08x}\n".format(conn.RESUME))
+        conn.resume_marker = marker
+        conn.RESUME_OFFSET = offset
+        if not offset:
+            return open(path, "wb")
+        sink = open(path, "r+b")
+        remaining = offset
+        while remaining:
+            chunk = sink.read(min(remaining, RESUME_READ))
+            conn.digest.update(chunk)
+            remaining -= len(chunk)
+        sink.truncate(offset)
+        sink.seek(offset)
+        return sink
+
+    # closes and forgets any other unfinished connection resuming the same transfer as conn
+    def drop_transfer(self, conn):
+        for address, other in list(self.connections.items()):
+            if other is not conn and other.RESUME == conn.RESUME and other.end_time is None:
+                if other.sink is not None:
+                    other.sink.close()
+                del self.connections[address]
+
+    # where a session's file goes - under the output directory by its own name, with any parts that would step
+    # outside it dropped. None when the output isn't a directory
+    def session_path(self, conn, name):
+        if self.output is None or not os.path.isdir(self.output):
+            return None
+        parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+        if not parts:
+            parts = ["tcpy_{}_{}.bin".format(conn.CLIENT_PORT, len(conn.frames.files))]
+        return os.path.join(self.output, *parts)
+
+    # opens where a session's file goes. A range is written into the file at its offset, leaving the rest of the
+    # file (e.g. ranges arriving on other connections) alone - the file is cut to total, the size of the whole
+    # file, so nothing is left past its end from an older, longer one. Every range cuts it to the same size, so
+    # whichever opens first does it. Files are only hashed when the output isn't a directory
+    def open_session_file(self, conn, name, offset=None, total=None):
+        path = self.session_path(conn, name)
+        if path is None:
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if offset is None:
+            return open(path, "wb")
+        sink = open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666), "wb")
+        os.ftruncate(sink.fileno(), total)
+        sink.seek(offset)
+        return sink
+
+    # size of a session's file on disk, None if it isn't written out
+    def session_file_size(self, conn, name):
+        path = self.session_path(conn, name)
+        try:
+            return os.path.getsize(path) if path is not None else None
+        except OSError:
+            return None
+
+    def completed(self, conn):
+        self.finished.append(conn)
+        if conn.resume_marker is not None:
+            try:
+                os.remove(conn.resume_marker)
+            except OSError:
+                pass
+        if self.on_complete is not None:
+            self.on_complete(conn)
+
+    # forgets completed connections once late retransmissions have had time to drain
+    def expire_connections(self):
+        current_time = time.monotonic()
+        for address, conn in list(self.connections.items()):
+            if conn.end_time is not None and current_time - conn.end_time > LINGER_TIME:
+                del self.connections[address]
+
+
+class Main:
+
+    # Parsing for argument flags
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-sp", required=True, type=int, help="supply server port information")
+    parser.add_argument("-a", default='', type=str, help="supply the address to listen on")
+    parser.add_argument("-o", default=None, type=str, help="supply an output file or directory")
+    parser.add_argument("-w", default=DEFAULT_WINDOW, type=int, help="advertised receive window in bytes")
+    parser.add_argument("-mss", default=MAX_MSS, type=int, help="largest segment accepted, offered in the SYN/ACK")
+    parser.add_argument("-loss", default=0.0, type=float, help="probability a datagram is lost")
+    parser.add_argument("-dup", default=0.0, type=float, help="probability a datagram is duplicated")
+    parser.add_argument("-reorder", default=0.0, type=float, help="probability a datagram is reordered")
+    parser.add_argument("-delay", default=0.0, type=float, help="one-way delay in seconds")
+    parser.add_argument("-jitter", default=0.0, type=float, help="delay variation in seconds")
+    parser.add_argument("-bw", default=None, type=float, help="bandwidth cap in bytes per second")
+    parser.add_argument("-queue", default=None, type=int, help="bottleneck queue size in bytes")
+
+    def __init__(self, argv=None):
+        args = self.parser.parse_args(argv)
+        if args.sp < 5000 or args.sp > 65535:
+            self.parser.exit(message="\tERROR(args): Server port out of range\n")
+        impairment = TCPyImpairment(loss=args.loss, duplicate=args.dup, reorder=args.reorder, delay=args.delay,
+                                    jitter=args.jitter, bandwidth=args.bw, queue=args.queue)
+        print("Listening on port:", args.sp)
+        print("Impairment:", impairment)
+        server = TCPyServer(args.a, args.sp, window=args.w, impairment=impairment, output=args.o, mss=args.mss,
+                            on_complete=lambda conn: print("RECEIVED:", conn.stats()))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    Main()
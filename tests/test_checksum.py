@@ -0,0 +1,66 @@
+"""
+test_checksum.py
+
+Behavioural tests for TCPyChecksumIndex - payload sums against TCPyPacket.sum16 at any offset and length,
+and dropping the samples of released regions. Skipped without NumPy.
+"""
+import random
+import unittest
+
+import TCPyChecksum
+from TCPyChecksum import BLOCK, checksum_index
+from TCPyPacket import TCPyPacket
+
+# a smaller REGION, so a few KB of data spans several
+REGION = 16 * BLOCK
+
+
+class TestChecksumIndex(unittest.TestCase):
+
+    def setUp(self):
+        region = TCPyChecksum.REGION
+        TCPyChecksum.REGION = REGION
+        self.addCleanup(setattr, TCPyChecksum, 'REGION', region)
+        self.rng = random.Random(0)
+        self.data = bytes(self.rng.getrandbits(8) for _ in range(20 * REGION + 37))
+        self.index = checksum_index(self.data)
+        if self.index is None:
+            self.skipTest("NumPy is not available")
+
+    def assertSum(self, index, offset, length):
+        self.assertEqual(index.payload_sum(offset, length), TCPyPacket.sum16(self.data[offset:offset + length]),
+                         "offset {}, length {}".format(offset, length))
+
+    def test_payload_sum_matches_sum16(self):
+        for _ in range(2000):
+            offset = self.rng.randrange(len(self.data))
+            self.assertSum(self.index, offset, self.rng.randint(0, min(3 * BLOCK, len(self.data) - offset)))
+
+    def test_block_and_file_edges(self):
+        size = len(self.data)
+        for offset in (0, 1, BLOCK - 1, BLOCK, REGION - 1, REGION, size - BLOCK - 1, size - 3, size - 1):
+            for length in (0, 1, 2, BLOCK - 1, BLOCK, BLOCK + 1, 2 * REGION):
+                self.assertSum(self.index, offset, min(length, size - offset))
+
+    def test_start(self):
+        index = checksum_index(self.data, 1001)
+        self.assertIsNone(index.payload_sum(BLOCK, 10))
+        for offset in (1001, 1002, 5000, len(self.data) - 100):
+            self.assertSum(index, offset, 99)
+
+    def test_release_drops_regions_below(self):
+        offset = 0
+        while offset < len(self.data):
+            length = min(self.rng.randint(1, 200), len(self.data) - offset)
+            self.assertSum(self.index, offset, length)
+            offset += length
+            self.index.release(offset - 300)
+            self.assertLessEqual(len(self.index.regions), 2)
+        self.assertGreater(self.index.base, 0)
+        # anything left above base still sums correctly
+        for offset in range(self.index.base, len(self.data), 7):
+            self.assertSum(self.index, offset, min(41, len(self.data) - offset))
+
+
+if __name__ == '__main__':
+    unittest.main()
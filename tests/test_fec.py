@@ -0,0 +1,83 @@
+"""
+test_fec.py
+
+Behavioural tests for FEC parity - the encoder's parity of a block and the decoder rebuilding its one
+missing segment, whichever it is and in whatever order the rest arrive.
+"""
+import random
+import unittest
+
+from TCPyFec import TCPyFecDecoder, TCPyFecEncoder
+
+
+# a block of segments of the given lengths from start, with the (start, length, count, parity) of its parity
+def block(lengths, start=1000, seed=0):
+    rng = random.Random(seed)
+    encoder = TCPyFecEncoder(len(lengths))
+    segments = []
+    offset = start
+    for length in lengths:
+        payload = bytes(rng.getrandbits(8) for _ in range(length))
+        encoder.add(offset, payload)
+        segments.append((offset, payload))
+        offset += length
+    return segments, encoder.close_block(offset, 0.0)
+
+
+class TestFecDecoder(unittest.TestCase):
+
+    def test_rebuilds_any_one_missing_segment(self):
+        # the last segment is short, as at the end of a file
+        segments, parity = block([100, 100, 100, 100, 37])
+        for missing in range(len(segments)):
+            decoder = TCPyFecDecoder(len(segments))
+            for i, (offset, payload) in enumerate(segments):
+                if i != missing:
+                    decoder.add(offset, payload)
+            self.assertEqual(decoder.add_parity(*parity), segments[missing])
+            self.assertEqual(decoder.recovered, 1)
+            self.assertEqual(decoder.pending, {})
+
+    def test_parity_before_the_rest_of_the_block(self):
+        segments, parity = block([64, 80, 72, 80])
+        decoder = TCPyFecDecoder(len(segments))
+        self.assertIsNone(decoder.add_parity(*parity))
+        decoder.add(*segments[3])
+        decoder.add(*segments[0])
+        self.assertEqual(decoder.check(segments[0][0]), [])
+        decoder.add(*segments[1])
+        self.assertEqual(decoder.check(segments[1][0]), [segments[2]])
+
+    def test_two_missing_segments_wait_for_a_retransmission(self):
+        segments, parity = block([50] * 6)
+        decoder = TCPyFecDecoder(len(segments))
+        for i in (0, 2, 4, 5):
+            decoder.add(*segments[i])
+        self.assertIsNone(decoder.add_parity(*parity))
+        self.assertIn(parity[0], decoder.pending)
+        # the retransmission of one leaves just one missing
+        decoder.add(*segments[3])
+        self.assertEqual(decoder.check(segments[3][0]), [segments[1]])
+
+    def test_complete_block_drops_its_parity(self):
+        segments, parity = block([30, 30, 30])
+        decoder = TCPyFecDecoder(len(segments))
+        for segment in segments:
+            decoder.add(*segment)
+        self.assertIsNone(decoder.add_parity(*parity))
+        self.assertEqual(decoder.pending, {})
+        self.assertEqual(decoder.recovered, 0)
+
+    def test_prune_forgets_delivered_blocks(self):
+        segments, parity = block([40] * 4)
+        decoder = TCPyFecDecoder(len(segments))
+        decoder.add(*segments[0])
+        decoder.add_parity(*parity)
+        end = segments[-1][0] + len(segments[-1][1])
+        decoder.prune(end + 10 * len(segments) * 40)
+        self.assertEqual(decoder.pending, {})
+        self.assertEqual(decoder.segments, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+test_scoreboard.py
+
+Behavioural tests for TCPyScoreboard - cumulative and selective ACKs, loss detection, and the skip index
+that keeps repeated SACK blocks from walking segments SACK'ed already.
+"""
+import random
+import unittest
+
+import TCPyScoreboard
+from TCPyScoreboard import TCPyScoreboard as Scoreboard
+
+MSS = 100
+
+
+# a scoreboard with count segments of MSS bytes sent from 0
+def sent(count):
+    scoreboard = Scoreboard()
+    for i in range(count):
+        scoreboard.add(i * MSS, (i + 1) * MSS, b'', 0.0)
+    return scoreboard
+
+
+def starts(segments):
+    return [segment.start for segment in segments]
+
+
+# a list counting reads of its items
+class CountingList(list):
+
+    reads = 0
+
+    def __getitem__(self, i):
+        self.reads += 1
+        return list.__getitem__(self, i)
+
+
+class TestScoreboard(unittest.TestCase):
+
+    def test_ack_retires_segments_below(self):
+        scoreboard = sent(5)
+        self.assertEqual(starts(scoreboard.ack(250)), [0, 100])
+        self.assertEqual(scoreboard.una, 200)
+        self.assertEqual(len(scoreboard), 3)
+        self.assertEqual(scoreboard.in_flight, 3 * MSS)
+        self.assertEqual(starts(scoreboard.ack(500)), [200, 300, 400])
+        self.assertIsNone(scoreboard.una)
+        self.assertEqual(scoreboard.in_flight, 0)
+
+    def test_sack_marks_whole_segments_once(self):
+        scoreboard = sent(6)
+        # a block only covering part of a segment doesn't SACK it
+        self.assertEqual(starts(scoreboard.sack(200, 450)), [200, 300])
+        self.assertEqual(starts(scoreboard.sack(200, 500)), [400])
+        self.assertEqual(scoreboard.sack(200, 500), [])
+        self.assertEqual(scoreboard.sacked, 3)
+        self.assertEqual(scoreboard.in_flight, 3 * MSS)
+        # SACK'ed data isn't reported again by the cumulative ACK covering it
+        self.assertEqual(starts(scoreboard.ack(600)), [0, 100, 500])
+        self.assertEqual(scoreboard.sacked, 0)
+
+    def test_sack_segment(self):
+        scoreboard = sent(4)
+        self.assertEqual(starts(scoreboard.sack_segment(300)), [200])
+        self.assertEqual(scoreboard.sack_segment(250), [])
+        self.assertEqual(starts(scoreboard.ack(0, skip_sacked=True)), [])
+        self.assertEqual(starts(scoreboard.sack_segment(100)), [0])
+        # per-segment ACKs retire SACK'ed segments reaching the head
+        self.assertEqual(scoreboard.ack(0, skip_sacked=True), [])
+        self.assertEqual(scoreboard.una, 100)
+
+    def test_detect_losses_after_dup_thresh(self):
+        scoreboard = sent(8)
+        scoreboard.sack(100, 300)
+        self.assertEqual(scoreboard.detect_losses(), [])
+        scoreboard.sack(300, 400)
+        self.assertEqual(starts(scoreboard.detect_losses()), [0])
+        # reported once only
+        self.assertEqual(scoreboard.detect_losses(), [])
+        scoreboard.sack(500, 800)
+        self.assertEqual(starts(scoreboard.detect_losses()), [400])
+
+    def test_repeated_sack_blocks_only_visit_new_segments(self):
+        scoreboard = sent(2000)
+        scoreboard.segments = CountingList(scoreboard.segments)
+        # the block a receiver sends after losing the first segment, one segment longer on every ACK
+        for i in range(1, 2000):
+            self.assertEqual(starts(scoreboard.sack(MSS, (i + 1) * MSS)), [i * MSS])
+        self.assertEqual(scoreboard.next_unsacked(1), 2000)
+        # walking the whole block every time would take about 2000 * 2000 / 2 steps
+        self.assertLess(scoreboard.segments.reads, 10 * 2000)
+
+    def test_matches_a_linear_scan(self):
+        compact_threshold = TCPyScoreboard.COMPACT_THRESHOLD
+        TCPyScoreboard.COMPACT_THRESHOLD = 8
+        self.addCleanup(setattr, TCPyScoreboard, 'COMPACT_THRESHOLD', compact_threshold)
+        rng = random.Random(0)
+        scoreboard = Scoreboard()
+        segments = []
+        end = una = 0
+        for _ in range(3000):
+            op = rng.random()
+            if op < 0.4:
+                length = rng.randint(1, 5)
+                segments.append(scoreboard.add(end, end + length, b'', 0.0))
+                end += length
+            elif op < 0.85:
+                left = rng.randint(una, end)
+                right = rng.randint(left, end)
+                expected = [s for s in segments if not s.sacked and s.start >= una and left <= s.start
+                            and s.end <= right]
+                self.assertEqual(scoreboard.sack(left, right), expected)
+            else:
+                una = rng.randint(una, end)
+                scoreboard.ack(una)
+                una = scoreboard.una if scoreboard.una is not None else end
+            outstanding = [s for s in segments if s.start >= una]
+            self.assertEqual(scoreboard.in_flight, sum(len(s) for s in outstanding if not s.sacked))
+            self.assertEqual(scoreboard.sacked, sum(s.sacked for s in outstanding))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+test_session.py
+
+Behavioural tests for TCPyFrameReader - a session stream of file and range frames read back however it is
+split up, headers included, and streams that end mid-file or hold something other than a frame.
+"""
+import hashlib
+import io
+import random
+import unittest
+
+from TCPySession import TCPyFrameReader, TCPySessionFile, frame_header
+
+
+# a file opened by the reader, kept once closed
+class Sink(io.BytesIO):
+
+    def __init__(self, opened, name, offset, total):
+        super().__init__()
+        self.opened = opened
+        self.key = (name, offset, total)
+
+    def close(self):
+        self.opened[self.key] = self.getvalue()
+        super().close()
+
+
+# a reader recording what it writes in opened, keyed by (name, offset, total)
+def reader(opened):
+    return TCPyFrameReader(lambda name, offset, total: Sink(opened, name, offset, total))
+
+
+# the session stream of files, each (name, data) or (name, data, offset, total) for a range
+def stream(files):
+    frames = []
+    for name, data, *part in files:
+        frames.append(frame_header(TCPySessionFile(None, name, len(data), *part)) + data)
+    return b''.join(frames)
+
+
+FILES = [
+    ('a.txt', b'hello world'),
+    ('empty', b''),
+    ('dir/b.bin', bytes(range(256)) * 3),
+    ('big.bin', b'x' * 5000, 1000, 9000),
+    ('été', b'unicode name'),
+]
+
+
+class TestFrameReader(unittest.TestCase):
+
+    def check(self, frames, opened):
+        self.assertIsNone(frames.error)
+        self.assertTrue(frames.complete)
+        self.assertEqual(len(frames.files), len(FILES))
+        for (name, data, *part), entry in zip(FILES, frames.files):
+            offset, total = part or (None, None)
+            self.assertEqual(entry, (name, len(data), hashlib.sha256(data).hexdigest(), offset, total))
+            self.assertEqual(opened[(name, offset, total)], data)
+
+    def test_whole_stream(self):
+        opened = {}
+        frames = reader(opened)
+        frames.feed(stream(FILES))
+        self.check(frames, opened)
+
+    def test_one_byte_at_a_time(self):
+        opened = {}
+        frames = reader(opened)
+        data = stream(FILES)
+        for i in range(len(data)):
+            frames.feed(data[i:i + 1])
+            if i < len(data) - 1:
+                self.assertLess(len(frames.files), len(FILES))
+        self.check(frames, opened)
+
+    def test_random_splits(self):
+        rng = random.Random(0)
+        data = stream(FILES)
+        for _ in range(50):
+            opened = {}
+            frames = reader(opened)
+            cuts = sorted(rng.sample(range(1, len(data)), 12))
+            for start, end in zip([0] + cuts, cuts + [len(data)]):
+                frames.feed(memoryview(data)[start:end])
+            self.check(frames, opened)
+
+    def test_header_split_inside_magic_and_name(self):
+        header = frame_header(TCPySessionFile(None, 'name.txt', 3))
+        for cut in range(1, len(header)):
+            opened = {}
+            frames = reader(opened)
+            frames.feed(header[:cut])
+            self.assertFalse(frames.complete)
+            self.assertEqual(frames.files, [])
+            frames.feed(header[cut:] + b'abc')
+            self.assertTrue(frames.complete)
+            self.assertEqual(opened[('name.txt', None, None)], b'abc')
+
+    def test_incomplete_stream(self):
+        frames = reader({})
+        frames.feed(stream(FILES)[:-1])
+        self.assertIsNone(frames.error)
+        self.assertFalse(frames.complete)
+
+    def test_bad_frame(self):
+        frames = reader({})
+        frames.feed(stream(FILES[:1]) + b'JUNK and more')
+        self.assertEqual(frames.error, "bad frame at file 2")
+        self.assertFalse(frames.complete)
+        self.assertEqual(len(frames.files), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()